@@ -0,0 +1,197 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from simulation import Simulation, summarize
+
+# drivers x reservations x grid size, every scenario runs with a fixed seed
+SCENARIOS = [
+    {'name': 'small', 'seed': 1, 'num_drivers': 20, 'num_reservations': 100, 'grid_size': 20, 'time': 7200.0},
+    {'name': 'medium', 'seed': 2, 'num_drivers': 50, 'num_reservations': 500, 'grid_size': 30, 'time': 18000.0},
+    {'name': 'large', 'seed': 3, 'num_drivers': 100, 'num_reservations': 1000, 'grid_size': 40, 'time': 36000.0},
+]
+
+# the scenarios above grow every axis at once, a sweep grows one axis and keeps
+# the others at SWEEP_BASE. The time leaves room for 1000 reservations.
+SWEEP_BASE = {'seed': 2, 'num_drivers': 50, 'num_reservations': 500, 'grid_size': 30, 'time': 36000.0}
+SWEEPS = {
+    'drivers': ('num_drivers', [25, 50, 100]),
+    'reservations': ('num_reservations', [250, 500, 1000]),
+    'grid': ('grid_size', [20, 30, 40]),
+}
+
+# metrics compared against the baseline and whether a larger value is worse
+COMPARED_METRICS = {
+    'init_seconds': True,
+    'run_seconds': True,
+    'analysis_seconds': True,
+    'events_per_second': False,
+    'peak_memory_bytes': True,
+}
+
+
+def create_simulation(scenario):
+    """Seeds numpy and builds the simulation of a scenario. The event log is discarded."""
+    np.random.seed(scenario['seed'])
+    return Simulation(
+        time=scenario['time'],
+        num_drivers=scenario['num_drivers'],
+        num_reservations=scenario['num_reservations'],
+        grid_size=scenario['grid_size'],
+        events_file=os.devnull
+    )
+
+
+def sweep_scenarios(axis):
+    """Lists the scenarios of a sweep, SWEEP_BASE with one argument changed"""
+    argument, values = SWEEPS[axis]
+    scenarios = []
+    for value in values:
+        scenario = dict(SWEEP_BASE, name='{}-{}'.format(axis, value))
+        scenario[argument] = value
+        scenarios.append(scenario)
+    return scenarios
+
+
+def time_scenario(scenario):
+    """Times the init, run and analysis phases of one scenario"""
+    start = time.perf_counter()
+    sim = create_simulation(scenario)
+    initialized = time.perf_counter()
+    sim.run()
+    ran = time.perf_counter()
+    analysis = summarize(sim)
+    waiting = sim.waiting.summary()
+    analyzed = time.perf_counter()
+
+    return {
+        'events': len(sim.all_events),
+        'init_seconds': initialized - start,
+        'run_seconds': ran - initialized,
+        'analysis_seconds': analyzed - ran,
+        'analysis': analysis,
+        'waiting': waiting
+    }
+
+
+def measure_memory(scenario):
+    """Reruns a scenario under tracemalloc. This is a separate pass so tracing does
+       not slow down the timed one, the fixed seed makes both handle the same events."""
+    gc.collect()
+    collections = sum(stats['collections'] for stats in gc.get_stats())
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    sim = create_simulation(scenario)
+    sim.run()
+    summarize(sim)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'peak_memory_bytes': peak,
+        'allocated_blocks': sys.getallocatedblocks() - blocks,
+        'gc_collections': sum(stats['collections'] for stats in gc.get_stats()) - collections
+    }
+
+
+def run_scenario(scenario, repeat=1, memory=True):
+    """Runs a scenario repeat times and keeps the fastest time of every phase"""
+    runs = []
+    for _ in range(repeat):
+        runs.append(time_scenario(scenario))
+    memory_result = measure_memory(scenario) if memory else {}
+
+    result = {key: value for key, value in scenario.items() if key != 'name'}
+    result['events'] = runs[0]['events']
+    for phase in ('init_seconds', 'run_seconds', 'analysis_seconds'):
+        result[phase] = min(run[phase] for run in runs)
+    result['events_per_second'] = result['events'] / result['run_seconds']
+    result.update(memory_result)
+    result['analysis'] = runs[0]['analysis']
+    result['waiting'] = runs[0]['waiting']
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Lists every metric that is more than tolerance worse than in the baseline
+
+    Args:
+        results (dict): scenario name to result, as returned by run_scenario
+        baseline (dict): a previous benchmark output
+        tolerance (float): allowed relative change, 0.1 is 10%
+
+    """
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['scenarios']:
+            continue
+        previous = baseline['scenarios'][name]
+        for metric, larger_is_worse in COMPARED_METRICS.items():
+            if metric not in result or metric not in previous or previous[metric] == 0:
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric]
+            if (larger_is_worse and change > tolerance) or (not larger_is_worse and change < -tolerance):
+                regressions.append({
+                    'scenario': name,
+                    'metric': metric,
+                    'baseline': previous[metric],
+                    'current': result[metric],
+                    'change': change
+                })
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the ride sharing simulation engine')
+    parser.add_argument('--scenarios', nargs='*', default=[scenario['name'] for scenario in SCENARIOS],
+                        choices=[scenario['name'] for scenario in SCENARIOS],
+                        help='regression scenarios to run, all by default, none when the flag has no names')
+    parser.add_argument('--sweep', nargs='+', default=[], choices=list(SWEEPS),
+                        help='also vary these axes one at a time, sweeps are not compared to the baseline')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scenario, the fastest is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--baseline', help='results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression')
+    args = parser.parse_args()
+
+    results = {}
+    for scenario in SCENARIOS:
+        if scenario['name'] in args.scenarios:
+            results[scenario['name']] = run_scenario(scenario, args.repeat, not args.no_memory)
+            sys.stderr.write('{}: {} events, {:.0f} events/s\n'.format(
+                scenario['name'], results[scenario['name']]['events'], results[scenario['name']]['events_per_second']))
+
+    sweeps = {}
+    for axis in args.sweep:
+        sweeps[axis] = {}
+        for scenario in sweep_scenarios(axis):
+            sweeps[axis][scenario['name']] = run_scenario(scenario, args.repeat, not args.no_memory)
+            sys.stderr.write('{}: {} events, {:.0f} events/s\n'.format(
+                scenario['name'], sweeps[axis][scenario['name']]['events'], sweeps[axis][scenario['name']]['events_per_second']))
+
+    output = {'python': sys.version.split()[0], 'numpy': np.__version__, 'scenarios': results}
+    if sweeps:
+        output['sweeps'] = sweeps
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        output['regressions'] = regressions
+        for regression in regressions:
+            sys.stderr.write('REGRESSION {scenario} {metric}: {baseline:.6g} -> {current:.6g} ({change:+.1%})\n'.format(**regression))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,240 @@
+import numpy as np
+
+
+def manhattan(a, b):
+    """Number of blocks between the rows of two (n, 2) arrays of intersections"""
+    return np.abs(a - b).sum(axis=1)
+
+
+def ride_alone(assignments, reservations):
+    """Keeps a reservation that does not approve of a carpool from sharing a driver
+       with the other reservations of the same dispatch. Assignments are kept in
+       order: a driver that got a carpool reservation skips the ones that do not
+       approve of a carpool, a driver that got one of those gets nothing more.
+
+    Args:
+        assignments (list): (driver index, reservation index) pairs of a policy
+        reservations (ReservationCandidates): the reservations that were dispatched
+
+    """
+
+    kept = []
+    carpool = {}
+    for i, j in assignments:
+        if i in carpool and not (carpool[i] and reservations.carpool[j]):
+            continue
+        carpool[i] = reservations.carpool[j]
+        kept.append((i, j))
+    return kept
+
+
+class DriverCandidates(object):
+    def __init__(self, drivers, block_time=60.0):
+        """NumPy view of the drivers a policy can choose from
+
+        Args:
+            drivers (list): driver dictionaries of the simulation
+            block_time (float): mean time to drive one block, used for estimates
+
+        Attributes:
+            drivers: the driver dictionaries (argument), index i of every array is drivers[i]
+            positions: (n, 2) current intersections
+            free_seats: seats that are neither taken nor promised to a pending assignment
+            load: seats that are taken or promised to a pending assignment
+            eta: estimated seconds until the driver has served its current reservations
+            destinations: (n, 2) intersection every driver is heading to, its position when idle
+
+        """
+
+        self.drivers = drivers
+        self.block_time = block_time
+        self.positions = np.array([driver['current_location'] for driver in drivers], dtype=float).reshape(-1, 2)
+        self.load = np.array([driver['seats_filled'] + driver['seats_promised'] for driver in drivers], dtype=int)
+        self.free_seats = np.array([driver['capacity'] for driver in drivers], dtype=int) - self.load
+        self._eta = None
+        self._destinations = None
+
+    def __len__(self):
+        return len(self.drivers)
+
+    @property
+    def eta(self):
+        # only computed for policies that use it
+        if self._eta is None:
+            blocks = []
+            for driver in self.drivers:
+                location = np.array(driver['current_location'])
+                remaining = 0
+                for reservation in driver['current_reservations']:
+                    dropoff = np.array(reservation['dropoff_coords'])
+                    if reservation['picked_up']:
+                        remaining += np.abs(dropoff - location).sum()
+                    else:
+                        pickup = np.array(reservation['current_location'])
+                        remaining += np.abs(pickup - location).sum() + np.abs(dropoff - pickup).sum()
+                blocks.append(remaining)
+            self._eta = np.array(blocks, dtype=float) * self.block_time
+        return self._eta
+
+    @property
+    def destinations(self):
+        if self._destinations is None:
+            destinations = self.positions.copy()
+            for i, driver in enumerate(self.drivers):
+                if len(driver['current_reservations']) > 0:
+                    # the same choice as Simulation.closest_reservation
+                    locations = np.array([reservation['current_location'] for reservation in driver['current_reservations']], dtype=float)
+                    closest = driver['current_reservations'][int(np.argmin(np.linalg.norm(locations - self.positions[i], axis=1)))]
+                    destinations[i] = closest['dropoff_coords'] if closest['picked_up'] else closest['current_location']
+            self._destinations = destinations
+        return self._destinations
+
+
+class ReservationCandidates(object):
+    def __init__(self, reservations, current_time=0.0):
+        """NumPy view of the reservations a policy can assign
+
+        Args:
+            reservations (list): reservation dictionaries of the simulation
+            current_time (float): time of the dispatch decision
+
+        Attributes:
+            reservations: the reservation dictionaries (argument), index j of every array is reservations[j]
+            positions: (m, 2) pickup intersections
+            dropoffs: (m, 2) dropoff intersections
+            party_size: seats every reservation needs
+            carpool: whether every reservation approves of a carpool
+            waiting: seconds since every reservation was made
+            current_time: time of the dispatch decision (argument)
+
+        """
+
+        self.reservations = reservations
+        self.current_time = current_time
+        self.positions = np.array([reservation['current_location'] for reservation in reservations], dtype=float).reshape(-1, 2)
+        self.dropoffs = np.array([reservation['dropoff_coords'] for reservation in reservations], dtype=float).reshape(-1, 2)
+        self.party_size = np.array([reservation['party_size'] for reservation in reservations], dtype=int)
+        self.carpool = np.array([reservation['carpool'] for reservation in reservations], dtype=bool)
+        self.waiting = current_time - np.array([reservation['reserve_time'] for reservation in reservations], dtype=float)
+
+    def __len__(self):
+        return len(self.reservations)
+
+
+class DispatchPolicy(object):
+    """Decides which driver serves which reservation
+
+    Simulation calls dispatch for new reservations and for idle drivers, and
+    carpool when a driver that is serving reservations arrives at an
+    intersection. Both receive DriverCandidates and ReservationCandidates and
+    return a list of (driver index, reservation index) assignments. A policy
+    must not assign more seats to a driver than it has free.
+    """
+
+    def dispatch(self, drivers, reservations):
+        raise NotImplementedError
+
+    def carpool(self, drivers, reservations):
+        return []
+
+
+class GreedyNearest(DispatchPolicy):
+    def __init__(self, carpool_threshold=3):
+        """Assigns every reservation, in order, to the closest driver with enough
+           free seats. A driver on its way picks up a carpool reservation whose
+           pickup is at most carpool_threshold blocks away in x and in y.
+           This is the policy the simulation has always used, except that the
+           original carpool search also offered riders that had not made their
+           reservation yet, the simulation now only offers waiting reservations.
+
+        Args:
+            carpool_threshold (int): The maximum number of blocks a driver should
+                veer off its path to pick up a carpool reservation
+
+        """
+
+        self.carpool_threshold = carpool_threshold
+
+    def scores(self, drivers, reservations, j):
+        """Cost of every driver serving reservation j, lower is better"""
+        difference = drivers.positions - reservations.positions[j]
+        return np.sqrt((difference ** 2).sum(axis=1))
+
+    def dispatch(self, drivers, reservations):
+        assignments = []
+        free_seats = drivers.free_seats.copy()
+        for j in range(len(reservations)):
+            fits = free_seats >= reservations.party_size[j]
+            if not fits.any():
+                continue
+            scores = np.where(fits, self.scores(drivers, reservations, j), np.inf)
+            i = int(np.argmin(scores))
+            free_seats[i] -= reservations.party_size[j]
+            assignments.append((i, j))
+        return assignments
+
+    def carpool(self, drivers, reservations):
+        assignments = []
+        if len(reservations) == 0:
+            return assignments
+        taken = np.zeros(len(reservations), dtype=bool)
+        for i in range(len(drivers)):
+            distance = np.abs(reservations.positions - drivers.positions[i])
+            close = (distance <= self.carpool_threshold).all(axis=1)
+            feasible = close & (reservations.party_size <= drivers.free_seats[i]) & ~taken
+            if feasible.any():
+                j = int(np.argmax(feasible))
+                taken[j] = True
+                assignments.append((i, j))
+        return assignments
+
+
+class EtaAware(GreedyNearest):
+    """Like GreedyNearest, but busy drivers count the time they still need for
+       their current reservations, so a free driver a little further away wins
+       over a close one that first has a long trip to finish."""
+
+    def scores(self, drivers, reservations, j):
+        return drivers.eta + manhattan(drivers.positions, reservations.positions[j]) * drivers.block_time
+
+
+class DetourBoundedCarpool(GreedyNearest):
+    def __init__(self, max_detour=4):
+        """Dispatches like GreedyNearest. A driver on its way only picks up the
+           carpool reservation that adds the fewest blocks to the trip to its
+           current destination, and only if it adds at most max_detour blocks.
+
+        Args:
+            max_detour (int): The maximum number of extra blocks of a carpool pickup
+
+        """
+
+        super(DetourBoundedCarpool, self).__init__()
+        # the carpool search is bounded by max_detour, there is no threshold
+        self.carpool_threshold = None
+        self.max_detour = max_detour
+
+    def carpool(self, drivers, reservations):
+        assignments = []
+        if len(reservations) == 0:
+            return assignments
+        taken = np.zeros(len(reservations), dtype=bool)
+        for i in range(len(drivers)):
+            position = drivers.positions[i]
+            destination = drivers.destinations[i]
+            detour = (manhattan(reservations.positions, position)
+                      + manhattan(reservations.positions, destination)
+                      - np.abs(destination - position).sum())
+            feasible = (detour <= self.max_detour) & (reservations.party_size <= drivers.free_seats[i]) & ~taken
+            if feasible.any():
+                j = int(np.argmin(np.where(feasible, detour, np.inf)))
+                taken[j] = True
+                assignments.append((i, j))
+        return assignments
+
+
+POLICIES = {
+    'greedy': GreedyNearest,
+    'eta': EtaAware,
+    'detour': DetourBoundedCarpool,
+}
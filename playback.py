@@ -0,0 +1,56 @@
+from bisect import bisect_right
+
+
+class Playback(object):
+    def __init__(self, events, speed=60.0):
+        """Time based replay of the events handled by a simulation
+
+        Instead of showing one event per tick, a cursor moves through simulated
+        time at a constant speed. Every call to advance hands back all of the
+        events that took place since the previous call, so the GUI can apply them
+        as one batch. When rendering falls behind, the next interval is simply
+        larger and the frames in between are skipped.
+
+        Args:
+            events (list): (time, event) tuples in the order they were handled,
+                usually Simulation.all_events
+            speed (float): simulated seconds that pass per second of wall time
+
+        Attributes:
+            events: events being replayed (argument)
+            speed: playback speed factor (argument)
+            times: non-decreasing event times, used to find interval boundaries
+            clock: current simulated time of the cursor
+            frame: index of the next event to hand out
+
+        """
+
+        self.events = events
+        self.speed = speed
+        # a negative travel time can schedule an event slightly in the past, keep
+        # the times non-decreasing so they can be bisected
+        self.times = []
+        latest = 0.0
+        for event in events:
+            latest = max(latest, event[0])
+            self.times.append(latest)
+        self.clock = 0.0
+        self.frame = 0
+
+    def advance(self, dt):
+        """Moves the cursor dt * speed simulated seconds forward and returns the
+           events that fall in the interval, in the order they were handled.
+
+        Args:
+            dt (float): wall time elapsed since the previous call
+
+        """
+
+        self.clock += dt * self.speed
+        start = self.frame
+        self.frame = bisect_right(self.times, self.clock, lo=start)
+        return self.events[start:self.frame]
+
+    def finished(self):
+        """True once every event has been handed out"""
+        return self.frame >= len(self.events)
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import time
+
+
+class CountingRandom(object):
+    def __init__(self, random, counts):
+        """Stands in for numpy.random and counts the calls of every function.
+           The wrapped functions are cached, so only the first lookup of a
+           name goes through __getattr__.
+
+        Args:
+            random: the module or generator that draws the numbers
+            counts (dict): function name to number of calls, updated in place
+
+        """
+
+        self.random = random
+        self.counts = counts
+
+    def __getattr__(self, name):
+        function = getattr(self.random, name)
+        counts = self.counts
+
+        def counted(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return function(*args, **kwargs)
+
+        setattr(self, name, counted)
+        return counted
+
+
+class SimulationProfiler(object):
+    def __init__(self, sample_every=100):
+        """Instrumentation of Simulation.run
+
+        Pass an instance as the profiler argument of Simulation. Without one the
+        simulation only pays for a check against None per event. Per event type
+        the profiler records the number of events and the time spent handling
+        them. It also records the size of the future event list, the number of
+        candidates every dispatch and carpool search looked at, and the number
+        of calls made to the random number generator.
+
+        Args:
+            sample_every (int): record the future event list size every this many events
+
+        Attributes:
+            event_counts: event type to number of handled events
+            event_seconds: event type to cumulative handler time
+            queue_samples: (time, size) samples of the future event list
+            max_queue_size: largest size of the future event list
+            scans: search name to list of candidate counts
+            random_calls: random function name to number of calls
+            sample_every: sampling interval of the future event list (argument)
+
+        """
+
+        self.event_counts = {}
+        self.event_seconds = {}
+        self.queue_samples = []
+        self.max_queue_size = 0
+        self.scans = {}
+        self.random_calls = {}
+        self.sample_every = sample_every
+        self.handled = 0
+
+    def wrap_random(self, random):
+        """Returns a stand in for random that counts its calls in random_calls"""
+        return CountingRandom(random, self.random_calls)
+
+    def clock(self):
+        return time.perf_counter()
+
+    def record_event(self, event_type, started, event_time, queue_size):
+        """Called after an event was handled
+
+        Args:
+            event_type (str): type of the handled event
+            started (float): clock() reading taken before the event was handled
+            event_time (float): simulated time of the event
+            queue_size (int): size of the future event list after handling the event
+
+        """
+
+        elapsed = time.perf_counter() - started
+        self.event_counts[event_type] = self.event_counts.get(event_type, 0) + 1
+        self.event_seconds[event_type] = self.event_seconds.get(event_type, 0.0) + elapsed
+        if queue_size > self.max_queue_size:
+            self.max_queue_size = queue_size
+        if self.handled % self.sample_every == 0:
+            self.queue_samples.append((event_time, queue_size))
+        self.handled += 1
+
+    def record_scan(self, name, candidates):
+        """Records that the search called name looked at candidates entities"""
+        self.scans.setdefault(name, []).append(candidates)
+
+    def summary(self):
+        """Everything recorded as a JSON serializable dictionary"""
+        scans = {}
+        for name, sizes in self.scans.items():
+            scans[name] = {
+                'searches': len(sizes),
+                'candidates': sum(sizes),
+                'mean_candidates': sum(sizes) / len(sizes),
+                'max_candidates': max(sizes)
+            }
+        return {
+            'events': {
+                event_type: {
+                    'count': count,
+                    'seconds': self.event_seconds[event_type],
+                    'mean_microseconds': self.event_seconds[event_type] / count * 1e6
+                }
+                for event_type, count in self.event_counts.items()
+            },
+            'future_event_list': {
+                'max_size': self.max_queue_size,
+                'samples': [[float(event_time), size] for event_time, size in self.queue_samples]
+            },
+            'scans': scans,
+            'random_calls': dict(self.random_calls)
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as output_file:
+            json.dump(self.summary(), output_file, indent=4)
+
+    def write_folded(self, path):
+        """Writes the handler times as folded stacks in microseconds, the input
+           format of flamegraph.pl and speedscope"""
+        with open(path, 'w') as output_file:
+            for event_type, seconds in sorted(self.event_seconds.items()):
+                output_file.write('Simulation.run;{} {}\n'.format(event_type, int(round(seconds * 1e6))))
+
+
+if __name__ == "__main__":
+    import numpy as np
+    from simulation import Simulation
+
+    parser = argparse.ArgumentParser(description='Profile one run of the ride sharing simulation')
+    parser.add_argument('--drivers', type=int, default=20)
+    parser.add_argument('--reservations', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', default='profile.json', help='path of the JSON summary')
+    parser.add_argument('--folded', help='also write folded stacks for a flame graph to this path')
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    profiler = SimulationProfiler()
+    sim = Simulation(num_drivers=args.drivers, num_reservations=args.reservations,
+                     events_file=os.devnull, profiler=profiler)
+    sim.run()
+
+    profiler.write_json(args.json)
+    if args.folded:
+        profiler.write_folded(args.folded)
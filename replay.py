@@ -0,0 +1,218 @@
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+
+import numpy as np
+
+from simulation import Simulation, summarize
+from results import load_results
+from dispatch import POLICIES
+
+# newer numpy versions log the coordinates as np.int64(x)
+COORDS = r'\((?:np\.int\d+\()?(\d+)\)?, (?:np\.int\d+\()?(\d+)\)?\)'
+RESERVATION_LINE = re.compile(r'^([\d.]+), reservation, ' + COORDS + r', ResId: (\d+), Party: (\d+), Pool: (\d+)$')
+IDLE_LINE = re.compile(r'^([\d.]+), idle_arrival, ')
+PICKUP_DROPOFF_LINE = re.compile(r'^[\d.]+, (pick up|drop off), ' + COORDS + r', DriverId: \d+, ResId: (\d+)$')
+
+
+def parse_events_log(path, grid_size=20, seed=0):
+    """Reads the reservations of an events.txt log as fixed demand
+
+    The reservation line of a reservation gives its time, party size and carpool
+    choice. Older logs also have reservations re-posted by idle arrivals, those
+    lines come right after the idle arrival line and have its rounded time. Such a
+    line is only used when the log has no other reservation line for the
+    reservation, so a real reservation that happens to follow an idle arrival at
+    the same second is still read. Pick up and drop off lines give the pickup and dropoff
+    intersections. The log has no dropoff location for riders that were never
+    dropped off, those are drawn once here from the simulation's distribution,
+    so every policy replayed on the demand still sees the same riders.
+
+    Args:
+        path (str): path of the log
+        grid_size (int): number of streets in each direction of the logged run
+        seed (int): seed for the missing dropoff locations
+
+    Returns:
+        list of reservations sorted by time, in the format of the demand argument of Simulation
+
+    """
+
+    reservations = {}
+    reposts = {}
+    pickups = {}
+    dropoffs = {}
+    idle_time = None
+    with open(path) as log:
+        for line in log:
+            line = line.strip()
+            match = RESERVATION_LINE.match(line)
+            if match:
+                reservation_id = int(match.group(4))
+                reservation = {
+                    'reserve_time': float(match.group(1)),
+                    'party_size': int(match.group(5)),
+                    'carpool': int(match.group(6)),
+                    'pickup_coords': (int(match.group(2)), int(match.group(3)))
+                }
+                # both lines round the time of the idle arrival, to seconds and tenths
+                if idle_time is not None and abs(reservation['reserve_time'] - idle_time) < 1.0:
+                    reposts.setdefault(reservation_id, reservation)
+                else:
+                    reservations.setdefault(reservation_id, reservation)
+                idle_time = None
+                continue
+            match = IDLE_LINE.match(line)
+            idle_time = float(match.group(1)) if match else None
+            match = PICKUP_DROPOFF_LINE.match(line)
+            if match:
+                locations = pickups if match.group(1) == 'pick up' else dropoffs
+                # a driver with several arrivals queued can log a pick up twice, the first is the real one
+                locations.setdefault(int(match.group(4)), (int(match.group(2)), int(match.group(3))))
+
+    for reservation_id, reservation in reposts.items():
+        reservations.setdefault(reservation_id, reservation)
+
+    random = np.random.RandomState(seed)
+    demand = []
+    for reservation_id in sorted(reservations):
+        reservation = reservations[reservation_id]
+        # riders carpooled before their reservation event are logged away from their pickup
+        if reservation_id in pickups:
+            reservation['pickup_coords'] = pickups[reservation_id]
+        if reservation_id in dropoffs:
+            reservation['dropoff_coords'] = dropoffs[reservation_id]
+        else:
+            reservation['dropoff_coords'] = Simulation.random_dropoff_coords(random, grid_size)
+        demand.append(reservation)
+    demand.sort(key=lambda reservation: reservation['reserve_time'])
+    return demand
+
+
+def round_trip(seed=0, num_drivers=20, num_reservations=100, grid_size=20):
+    """Runs a simulation, reads its events.txt back with parse_events_log and
+       compares the parsed demand with the reservations of the run
+
+    Returns:
+        list of (reservation id, field) that were not read back correctly. Times
+        are compared to the second the log keeps, dropoffs only of riders that
+        were dropped off.
+
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        events_file = os.path.join(directory, 'events.txt')
+        np.random.seed(seed)
+        sim = Simulation(num_drivers=num_drivers, num_reservations=num_reservations,
+                         grid_size=grid_size, events_file=events_file)
+        sim.run()
+        demand = parse_events_log(events_file, grid_size, seed)
+
+    mismatches = []
+    reservations = sorted(sim.reservations, key=lambda reservation: reservation['reserve_time'])
+    if len(demand) != len(reservations):
+        mismatches.append((None, 'count'))
+    for parsed, reservation in zip(demand, reservations):
+        reservation_id = reservation['reservation_id']
+        if abs(parsed['reserve_time'] - reservation['reserve_time']) > 0.5:
+            mismatches.append((reservation_id, 'reserve_time'))
+        for field in ('party_size', 'carpool', 'pickup_coords'):
+            if parsed[field] != reservation[field]:
+                mismatches.append((reservation_id, field))
+        if reservation['dropoff_time'] >= 0 and tuple(parsed['dropoff_coords']) != reservation['dropoff_coords']:
+            mismatches.append((reservation_id, 'dropoff_coords'))
+    return mismatches
+
+
+def load_demand(directory):
+    """Reads the reservations of a run written by results.write_results as fixed
+       demand. Unlike the text log this has the exact times and locations."""
+    reservations = load_results(directory)['reservations']
+    demand = []
+    for index in np.argsort(reservations['reserve_time'], kind='stable'):
+        demand.append({
+            'reserve_time': float(reservations['reserve_time'][index]),
+            'party_size': int(reservations['party_size'][index]),
+            'carpool': int(reservations['carpool'][index]),
+            'pickup_coords': (int(reservations['pickup_x'][index]), int(reservations['pickup_y'][index])),
+            'dropoff_coords': (int(reservations['dropoff_x'][index]), int(reservations['dropoff_y'][index]))
+        })
+    return demand
+
+
+def replay(demand, variants, seed=0):
+    """Runs every variant on the same demand
+
+    Every variant starts from the same seed, so they also share the drivers and,
+    as far as their decisions allow, the travel times. Differences between the
+    results then come from the variants and not from sampling noise.
+
+    Args:
+        demand (list): fixed reservations from parse_events_log or load_demand
+        variants (dict): variant name to keyword arguments of Simulation
+        seed (int): numpy seed every variant starts from
+
+    Returns:
+        dictionary of variant name to finished Simulation
+
+    """
+
+    simulations = {}
+    for name, arguments in variants.items():
+        arguments = dict(arguments)
+        arguments.setdefault('events_file', os.devnull)
+        np.random.seed(seed)
+        sim = Simulation(demand=demand, **arguments)
+        sim.run()
+        simulations[name] = sim
+    return simulations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay the reservations of a recorded run against several variants')
+    parser.add_argument('source', nargs='?', help='an events.txt log or a directory written by results.py')
+    parser.add_argument('--drivers', type=int, nargs='+', default=[20])
+    parser.add_argument('--carpool-thresholds', type=int, nargs='+', default=[3])
+    parser.add_argument('--policies', nargs='+', default=['greedy'], choices=sorted(POLICIES),
+                        help='dispatch policies, carpool thresholds apply to greedy and eta')
+    parser.add_argument('--grid-size', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true',
+                        help='instead of replaying, check that a fresh run of seed is read back from its log')
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = round_trip(args.seed, args.drivers[0], grid_size=args.grid_size)
+        print(json.dumps({'seed': args.seed, 'mismatches': mismatches}))
+        sys.exit(1 if mismatches else 0)
+    if args.source is None:
+        parser.error('source is required unless --check is given')
+
+    if os.path.isdir(args.source):
+        demand = load_demand(args.source)
+    else:
+        demand = parse_events_log(args.source, args.grid_size, args.seed)
+
+    variants = {}
+    for num_drivers, policy in itertools.product(args.drivers, args.policies):
+        # eta dispatches differently but carpools like greedy
+        thresholds = args.carpool_thresholds if policy in ('greedy', 'eta') else [None]
+        for carpool_threshold in thresholds:
+            name = 'drivers={} policy={}'.format(num_drivers, policy)
+            if carpool_threshold is None:
+                dispatch_policy = POLICIES[policy]()
+            else:
+                name += ' carpool_threshold={}'.format(carpool_threshold)
+                dispatch_policy = POLICIES[policy](carpool_threshold)
+            variants[name] = {
+                'num_drivers': num_drivers,
+                'grid_size': args.grid_size,
+                'dispatch_policy': dispatch_policy
+            }
+
+    simulations = replay(demand, variants, args.seed)
+    print(json.dumps({name: summarize(sim) for name, sim in simulations.items()}, indent=4))
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+EVENT_TYPES = ['reservation', 'reservation assignment', 'intersection arrival', 'pick up', 'drop off', 'idle_arrival']
+EVENT_CODES = {event_type: code for code, event_type in enumerate(EVENT_TYPES)}
+
+RESERVATION_COLUMNS = [
+    ('reservation_id', np.int32),
+    ('party_size', np.int8),
+    ('carpool', np.bool_),
+    ('reserve_time', np.float64),
+    ('pickup_time', np.float64),
+    ('dropoff_time', np.float64),
+    ('pickup_x', np.int16),
+    ('pickup_y', np.int16),
+    ('dropoff_x', np.int16),
+    ('dropoff_y', np.int16),
+    ('driver_id', np.int32),
+]
+
+TRAJECTORY_COLUMNS = [
+    ('driver_id', np.int32),
+    ('time', np.float64),
+    ('x', np.int16),
+    ('y', np.int16),
+]
+
+EVENT_COLUMNS = [
+    ('time', np.float64),
+    ('event_type', np.int8),
+    ('driver_id', np.int32),
+    ('reservation_id', np.int32),
+    ('x', np.int16),
+    ('y', np.int16),
+]
+
+
+def reservation_rows(sim):
+    for res in sim.reservations:
+        yield (
+            res['reservation_id'],
+            res['party_size'],
+            res['carpool'],
+            res['reserve_time'],
+            res['pickup_time'],
+            res['dropoff_time'],
+            res['pickup_coords'][0],
+            res['pickup_coords'][1],
+            res['dropoff_coords'][0],
+            res['dropoff_coords'][1],
+            -1 if res['driver'] is None else res['driver']['driver_id']
+        )
+
+
+def trajectory_rows(sim):
+    """One row every time a driver arrives at an intersection"""
+    for time, event in sim.all_events:
+        if event['event_type'] == 'intersection arrival':
+            driver = event['event']['driver']
+            yield (driver['driver_id'], time, driver['current_location'][0], driver['current_location'][1])
+
+
+def event_rows(sim):
+    """One row per handled event with the unrounded time. The location is the one
+       of the driver, or of the reservation for events without a driver."""
+    for time, event in sim.all_events:
+        driver = event['event'].get('driver')
+        reservation = event['event'].get('reservation')
+        location = driver['current_location'] if driver is not None else reservation['current_location']
+        yield (
+            time,
+            EVENT_CODES[event['event_type']],
+            -1 if driver is None else driver['driver_id'],
+            -1 if reservation is None else reservation['reservation_id'],
+            location[0],
+            location[1]
+        )
+
+
+def write_table(directory, columns, rows):
+    """Writes every column of rows as its own .npy file in directory"""
+    os.makedirs(directory, exist_ok=True)
+    rows = list(rows)
+    for index, (name, dtype) in enumerate(columns):
+        np.save(os.path.join(directory, name + '.npy'), np.array([row[index] for row in rows], dtype=dtype))
+
+
+def write_results(sim, directory):
+    """Writes the results of a finished simulation as typed columnar files
+
+    Every table is a directory with one .npy file per column. Numpy can memory
+    map those files, and they map one to one onto the columns of an Arrow or
+    Parquet table. meta.json holds the simulation arguments, the class name of
+    the dispatch policy and the names of the event type codes.
+
+    Args:
+        sim (Simulation): a simulation after run
+        directory (str): output directory, created if it does not exist
+
+    """
+
+    write_table(os.path.join(directory, 'reservations'), RESERVATION_COLUMNS, reservation_rows(sim))
+    write_table(os.path.join(directory, 'trajectories'), TRAJECTORY_COLUMNS, trajectory_rows(sim))
+    write_table(os.path.join(directory, 'events'), EVENT_COLUMNS, event_rows(sim))
+
+    meta = {
+        'time': sim.time,
+        'num_drivers': sim.num_drivers,
+        'num_reservations': sim.num_reservations,
+        'dispatch_policy': type(sim.dispatch_policy).__name__,
+        'carpool_threshold': sim.carpool_threshold,
+        'grid_size': sim.grid_size,
+        'event_types': EVENT_TYPES
+    }
+    with open(os.path.join(directory, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=4)
+
+
+def load_results(directory, mmap_mode='r'):
+    """Loads a directory written by write_results. The columns are memory mapped,
+       so nothing is read until it is used.
+
+    Returns:
+        dictionary with the meta data under 'meta' and every table as a dictionary
+        of column name to array under 'reservations', 'trajectories' and 'events'
+
+    """
+
+    with open(os.path.join(directory, 'meta.json')) as meta_file:
+        results = {'meta': json.load(meta_file)}
+    for table, columns in (('reservations', RESERVATION_COLUMNS),
+                           ('trajectories', TRAJECTORY_COLUMNS),
+                           ('events', EVENT_COLUMNS)):
+        results[table] = {
+            name: np.load(os.path.join(directory, table, name + '.npy'), mmap_mode=mmap_mode)
+            for name, _ in columns
+        }
+    return results
+
+
+def load_runs(directories, mmap_mode='r'):
+    """load_results for every directory, e.g. one per replication"""
+    return [load_results(directory, mmap_mode) for directory in directories]
+
+
+if __name__ == "__main__":
+    from simulation import Simulation
+
+    parser = argparse.ArgumentParser(description='Run the ride sharing simulation and write columnar results')
+    parser.add_argument('directory')
+    parser.add_argument('--drivers', type=int, default=20)
+    parser.add_argument('--reservations', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    sim = Simulation(num_drivers=args.drivers, num_reservations=args.reservations, events_file=os.devnull)
+    sim.run()
+    write_results(sim, args.directory)
@@ -5,14 +5,20 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 import cocos
 from cocos.director import director
+from cocos.batch import BatchNode
+from cocos.cocosnode import CocosNode
 from cocos.actions import *
 
+import pyglet
+from pyglet.gl import glPushMatrix, glPopMatrix
 from pyglet.window.key import symbol_string
 from simulation import Simulation
+from playback import Playback
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--drivers', type=int, default=20)
 parser.add_argument('--reservations', type=int, default=100)
+parser.add_argument('--speed', type=float, default=60.0, help='simulated seconds shown per second')
 ARGS = parser.parse_args()
 
 class RideSharing(cocos.layer.Layer):
@@ -54,24 +60,40 @@ class RideSharing(cocos.layer.Layer):
 
         self.shift_x = 400
         self.shift_y = 20
-        self.duration = 0.01
         self.dt = 0.05
         self.intersections = []
         self.icoords = []
         self.cars = []
         self.car_labels = []
-        self.active_reservations = []
+        self.active_reservations = {}
+
+        # every texture is loaded once and shared by all sprites showing it
+        self.intersection_image = pyglet.image.load('resources/intersection.jpg')
+        self.car_image = pyglet.image.load('resources/ferrari.png')
+        self.reservation_image = pyglet.image.load('resources/reservation.png')
+
+        # sprites and labels are drawn in batches so thousands of drivers stay interactive
+        self.map_batch = BatchNode()
+        self.reservation_batch = BatchNode()
+        self.car_batch = BatchNode()
+        self.label_batch = LabelBatch()
+        self.add(self.map_batch, z=0)
+        self.add(self.reservation_batch, z=1)
+        self.add(self.car_batch, z=2)
+        self.add(self.label_batch, z=3)
+        self.reservation_pool = SpritePool(self.reservation_image, self.reservation_batch)
+
         self.simulation = Simulation(num_drivers=ARGS.drivers, num_reservations=ARGS.reservations)
         self.initialize_map()
         self.initialize_monitor()
 
-        self.reservation_ids = []
-        self.first_time_moves = []
+        self.reservation_ids = set()
+        self.first_time_moves = set()
 
         self.simulation.run()
         
         self.all_events = self.simulation.all_events
-        self.frame = 0
+        self.playback = Playback(self.all_events, speed=ARGS.speed)
 
         self.free_rides = 0
         self.completed_reservations = set()
@@ -130,24 +152,26 @@ class RideSharing(cocos.layer.Layer):
         # place intersections
         for x in range(0 + self.shift_x, 1000 + self.shift_x, 50):
             for y in range(0 + self.shift_y, 1000 + self.shift_y, 50):
-                isection = cocos.sprite.Sprite('resources/intersection.jpg')
+                isection = cocos.sprite.Sprite(self.intersection_image)
                 isection.position = x, y
                 self.intersections.append(isection)
                 self.icoords.append((x,y))
-                self.add(isection)
+                self.map_batch.add(isection)
 
         # place cars
         for driver in self.simulation.drivers:
-            car = cocos.sprite.Sprite('resources/ferrari.png')
-            car.position = (driver['initial_location'][0]*50 + self.shift_x, driver['initial_location'][1]*50 + self.shift_y)
+            car = cocos.sprite.Sprite(self.car_image)
+            car.position = self.to_screen(driver['initial_location'])
             self.cars.append(car)
-            car_id_label = cocos.text.Label(
+            car_id_label = pyglet.text.Label(
                 str(driver['driver_id']),
                 font_name = 'Arial',
                 font_size = 12,
                 anchor_x = 'center',
                 anchor_y = 'center',
-                position = (driver['initial_location'][0]*50 + self.shift_x + 20, driver['initial_location'][1]*50 + self.shift_y - 20)
+                x = car.position[0] + 20,
+                y = car.position[1] - 20,
+                batch = self.label_batch.batch
             )
             # car_capacity_label = cocos.text.Label(
             #     str(driver['capacity']),
@@ -159,72 +183,113 @@ class RideSharing(cocos.layer.Layer):
             # )
             # self.add(car_capacity_label)
             self.car_labels.append(car_id_label)
-            self.add(car)
-            self.add(car_id_label)
+            self.car_batch.add(car)
 
     def run_simulation(self, dt):
-        if self.frame < len(self.all_events):
-            next_event = self.all_events[self.frame]
-            event_time = next_event[0]
-            event_type = next_event[1]['event_type']
-            event = next_event[1]['event']
-            self.time_label.element.text = '{}:{}'.format(int(event_time/60), '{0:0>2}'.format(int(event_time%60)))
+        events = self.playback.advance(dt)
+        if len(events) == 0:
+            return
 
+        # apply the whole interval as one batch, only the last move of every sprite is drawn.
+        # a reservation moved to None is finished and its sprite goes back to the pool
+        car_moves = {}
+        reservation_moves = {}
+        for event_time, event in events:
+            event_type = event['event_type']
+            event = event['event']
             if event_type == 'reservation':
                 event = event['reservation']
                 if event['reservation_id'] not in self.reservation_ids:
-                    self.reservation_ids.append(event['reservation_id'])
-                    self.first_time_moves.append(False)
-                    reservation = cocos.sprite.Sprite('resources/reservation.png')
-                    location = (event['current_location'][0]*50 + self.shift_x, event['current_location'][1]*50 + self.shift_y)
-                    reservation.position = location
-                    self.active_reservations.append(reservation)
+                    reservation_moves[event['reservation_id']] = self.to_screen(event['current_location'])
             elif event_type == 'intersection arrival':
                 driver = event['driver']
-                self.move_to_intersection(driver, event_time)
-            self.frame += 1
+                self.move_to_intersection(driver, event_time, car_moves, reservation_moves)
+            elif event_type == 'drop off':
+                reservation_moves[event['reservation']['reservation_id']] = None
+
+        for id, position in car_moves.items():
+            self.cars[id].position = position
+            self.car_labels[id].x = position[0] + 20
+            self.car_labels[id].y = position[1] - 20
+        for reservation_id, position in reservation_moves.items():
+            if position is None:
+                self.reservation_ids.add(reservation_id)
+                sprite = self.active_reservations.pop(reservation_id, None)
+                if sprite is not None:
+                    self.reservation_pool.release(sprite)
+            elif reservation_id in self.active_reservations:
+                self.active_reservations[reservation_id].position = position
+            elif reservation_id not in self.reservation_ids:
+                # carpools can pick up a rider before its reservation event is shown
+                self.reservation_ids.add(reservation_id)
+                self.active_reservations[reservation_id] = self.reservation_pool.acquire(position)
+
+        self.completed_amount_label.element.text = str(len(self.completed_reservations))
+        self.free_amount_label.element.text = str(self.free_rides)
+        self.time_label.element.text = '{}:{}'.format(int(event_time/60), '{0:0>2}'.format(int(event_time%60)))
 
-    def move_to_intersection(self, driver, time):
+    def move_to_intersection(self, driver, time, car_moves, reservation_moves):
         id = driver['driver_id']
         driver_position = driver['current_location']
-        driver_sprite = self.cars[id]
-        driver_new_position = (driver_position[0]*50 + self.shift_x, driver_position[1]*50 + self.shift_y)
-        driver_sprite.do(MoveTo(driver_new_position, self.duration))
-
-        car_id_sprite = self.car_labels[id]
-        car_id_sprite_new_position = (driver_position[0]*50 + self.shift_x + 20, driver_position[1]*50 + self.shift_y - 20)
-        car_id_sprite.do(MoveTo(car_id_sprite_new_position, self.duration))
+        car_moves[id] = self.to_screen(driver_position)
 
         for reservation in driver['current_reservations']:
             reservation_location = reservation['current_location']
             reservation_destination = reservation['dropoff_coords']
             reservation_id = reservation['reservation_id']
-            reservation_sprite = self.active_reservations[reservation_id]
-
-            reserve_time = reservation['reserve_time']
-            dropoff_time = reservation['dropoff_time']
-            if time >= reserve_time:
-                self.add(reservation_sprite)
 
             if reservation_location[0] == reservation_destination[0] and reservation_location[1] == reservation_destination[1]:
-                reservation_sprite.do(Place((-100, -100)))
+                reservation_moves[reservation_id] = None
                 self.completed_reservations.add(reservation_id)
-                self.completed_amount_label.element.text = str(len(self.completed_reservations))
             elif driver_position[0] == reservation_location[0] and driver_position[1] == reservation_location[1]:
-                new_reservation_location = (reservation_location[0]*50 + self.shift_x, reservation_location[1]*50 + self.shift_y)
-                reservation_sprite.do(MoveTo(new_reservation_location, self.duration))
+                reservation_moves[reservation_id] = self.to_screen(reservation_location)
 
-                if not self.first_time_moves[reservation_id]:
-                    self.first_time_moves[reservation_id] = True
+                if reservation_id not in self.first_time_moves:
+                    self.first_time_moves.add(reservation_id)
                     if (time - reservation['reserve_time'])/60.0 > 15.0:
                         self.free_rides += 1
-                        self.free_amount_label.element.text = str(self.free_rides)
 
-        for reservation in driver['serviced_passengers']:
-            reservation_id = reservation['reservation_id']
-            reserve_spr = self.active_reservations[reservation_id]
-            reserve_spr.do(Place((-100,-100)))
+    def to_screen(self, location):
+        return (location[0]*50 + self.shift_x, location[1]*50 + self.shift_y)
+
+
+class SpritePool(object):
+    """Hands out sprites that share one image. Released sprites are hidden and
+       reused by the next acquire, so the number of sprites never exceeds the
+       number shown at the same time."""
+
+    def __init__(self, image, batch):
+        self.image = image
+        self.batch = batch
+        self.free = []
+
+    def acquire(self, position):
+        if len(self.free) > 0:
+            sprite = self.free.pop()
+            sprite.visible = True
+        else:
+            sprite = cocos.sprite.Sprite(self.image)
+            self.batch.add(sprite)
+        sprite.position = position
+        return sprite
+
+    def release(self, sprite):
+        sprite.visible = False
+        self.free.append(sprite)
+
+
+class LabelBatch(CocosNode):
+    """Draws many pyglet labels through one shared pyglet.graphics.Batch"""
+
+    def __init__(self):
+        super(LabelBatch, self).__init__()
+        self.batch = pyglet.graphics.Batch()
 
+    def draw(self):
+        glPushMatrix()
+        self.transform()
+        self.batch.draw()
+        glPopMatrix()
 
 
 # initialize and create a window
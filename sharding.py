@@ -0,0 +1,577 @@
+import argparse
+import bisect
+import collections
+import heapq
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from simulation import Simulation, WaitingQueue, summarize
+from dispatch import DispatchPolicy, DriverCandidates, ReservationCandidates, ride_alone
+
+
+def region_bounds(grid_size, num_shards):
+    """Splits the grid into num_shards strips of streets in the x direction and
+       returns the first street of every strip"""
+    return [grid_size * k // num_shards for k in range(num_shards)]
+
+
+def region_of(bounds, x):
+    return bisect.bisect_right(bounds, x) - 1
+
+
+def demand_of(reservation):
+    """The arguments of Simulation.add_reservation that recreate a reservation"""
+    return {
+        'reservation_id': reservation['reservation_id'],
+        'reserve_time': reservation['reserve_time'],
+        'party_size': reservation['party_size'],
+        'carpool': reservation['carpool'],
+        'pickup_coords': reservation['pickup_coords'],
+        'dropoff_coords': reservation['dropoff_coords']
+    }
+
+
+def driver_snapshot(driver):
+    """The fields of a driver dispatch policies look at, without references to
+       the rest of the simulation. Numpy scalars become ints, which are much
+       cheaper to compare and to send to the coordinator."""
+    return {
+        'driver_id': driver['driver_id'],
+        'current_location': [int(coordinate) for coordinate in driver['current_location']],
+        'idle': bool(driver['idle']),
+        'capacity': int(driver['capacity']),
+        'seats_filled': int(driver['seats_filled']),
+        'seats_promised': int(driver['seats_promised']),
+        'current_reservations': [
+            {
+                'current_location': [int(coordinate) for coordinate in reservation['current_location']],
+                'dropoff_coords': tuple(int(coordinate) for coordinate in reservation['dropoff_coords']),
+                'picked_up': reservation['picked_up']
+            }
+            for reservation in driver['current_reservations']
+        ]
+    }
+
+
+class PresetDispatch(DispatchPolicy):
+    def __init__(self, policy):
+        """Dispatch policy of a shard. New reservations arrive with the driver the
+           coordinator chose for them, they are assigned to that driver if it is
+           still in the shard and has room. Everything else is left to policy.
+
+        Args:
+            policy (DispatchPolicy): the policy of the sharded run
+
+        """
+
+        self.policy = policy
+
+    def dispatch(self, drivers, reservations):
+        assignments = []
+        rest = []
+        free_seats = drivers.free_seats.copy()
+        index = {driver['driver_id']: i for i, driver in enumerate(drivers.drivers)}
+        for j, reservation in enumerate(reservations.reservations):
+            i = index.get(reservation.get('preset_driver_id'))
+            if i is not None and free_seats[i] >= reservations.party_size[j]:
+                free_seats[i] -= reservations.party_size[j]
+                assignments.append((i, j))
+            else:
+                rest.append(j)
+
+        if len(rest) > 0:
+            drivers.free_seats = free_seats
+            remaining = ReservationCandidates([reservations.reservations[j] for j in rest], reservations.current_time)
+            for i, k in self.policy.dispatch(drivers, remaining):
+                assignments.append((i, rest[k]))
+        return assignments
+
+    def carpool(self, drivers, reservations):
+        return self.policy.carpool(drivers, reservations)
+
+
+class ReportingQueue(WaitingQueue):
+    def __init__(self):
+        """Waiting queue of a shard. It remembers the reservations that were queued
+           and pulled since the last report, so the coordinator can keep a copy of
+           the waiting reservations of all shards.
+
+        Attributes:
+            pushed: ids of the reservations queued since the last report
+            pulled: ids of the reservations pulled since the last report
+        """
+
+        super(ReportingQueue, self).__init__()
+        self.pushed = []
+        self.pulled = []
+
+    def push(self, reservation, time):
+        super(ReportingQueue, self).push(reservation, time)
+        self.pushed.append(reservation['reservation_id'])
+
+    def pull(self, reservations, time):
+        super(ReportingQueue, self).pull(reservations, time)
+        self.pulled.extend(reservation['reservation_id'] for reservation in reservations)
+
+    def withdraw(self, reservation_id, time):
+        """Removes a reservation a driver of another shard pulled and returns it,
+           the coordinator records its wait"""
+        reservation = next(reservation for reservation in self.reservations if reservation['reservation_id'] == reservation_id)
+        self.reservations = collections.deque(waiting for waiting in self.reservations if waiting is not reservation)
+        self.backlog.append((time, len(self.reservations)))
+        return reservation
+
+    def report(self):
+        """The ids queued and pulled since the last report"""
+        report = (self.pushed, self.pulled)
+        self.pushed = []
+        self.pulled = []
+        return report
+
+
+class ShardSimulation(Simulation):
+    def __init__(self, shard, bounds, drivers, policy, min_block_time=20.0, **arguments):
+        """Simulation of one region of a sharded run
+
+        The shard starts with the drivers in its region and no reservations, the
+        coordinator sends it every reservation once it chose a driver for it.
+        Reservations no driver had room for wait in the queue of the shard,
+        idle drivers and carpools of the region pull from it, idle drivers of
+        other regions through the coordinator, see ReportingQueue. After every
+        time window the drivers that drove into another region are removed
+        together with their reservations and queued events and put in the
+        outbox, the coordinator hands them to the shards that own those regions.
+        The time to drive a block is at least min_block_time, which is the
+        length of the time windows.
+
+        Args:
+            shard (int): index of the region of the shard
+            bounds (list): first street of every region, see region_bounds
+            drivers (list): driver dictionaries starting in the region
+            policy (DispatchPolicy): dispatch policy of the run
+            min_block_time (float): the least time it takes to drive a block
+            arguments: further keyword arguments of Simulation
+
+        Attributes:
+            outbox: (driver, queued events) of drivers that left the region
+
+        """
+
+        self.shard = shard
+        self.bounds = bounds
+        self.min_block_time = min_block_time
+        self.outbox = []
+        super(ShardSimulation, self).__init__(num_drivers=0, demand=[], dispatch_policy=PresetDispatch(policy), **arguments)
+        self.drivers = drivers
+        self.num_drivers = len(drivers)
+        self.waiting = ReportingQueue()
+
+    def owns(self, location):
+        return region_of(self.bounds, location[0]) == self.shard
+
+    def update_locations(self, driver, closest_reservation, picked_up = False):
+        arrival_time_length = super(ShardSimulation, self).update_locations(driver, closest_reservation, picked_up)
+        if arrival_time_length == -1:
+            return -1
+        return max(arrival_time_length, self.min_block_time)
+
+    def hand_off(self):
+        """Moves the drivers that left the region to the outbox, with their current
+           reservations and every event that is still queued for them. A driver
+           can have several intersection arrivals queued, they all go along."""
+
+        leaving = [driver for driver in self.drivers if not self.owns(driver['current_location'])]
+        if len(leaving) == 0:
+            return
+        leaving_ids = set(id(driver) for driver in leaving)
+        queue = self.future_event_list.queue
+        staying = [entry for entry in queue if id(entry[2]['event'].get('driver')) not in leaving_ids]
+        # reservations that events staying here still refer to
+        referenced = set(id(entry[2]['event'].get('reservation')) for entry in staying)
+
+        moving = set()
+        for driver in leaving:
+            moving.update(id(reservation) for reservation in driver['current_reservations'])
+        for driver in leaving:
+            events = []
+            for entry in sorted(entry for entry in queue if entry[2]['event'].get('driver') is driver):
+                if entry[2]['event_type'] == 'reservation assignment':
+                    reservation = entry[2]['event']['reservation']
+                    # an assignment of a reservation that is taken, or that another
+                    # driver may still take here, would not happen in the new region.
+                    # pick ups and drop offs are of current reservations and always go along
+                    if reservation['assigned'] or id(reservation) in referenced or id(reservation) in moving:
+                        driver['seats_promised'] -= reservation['party_size']
+                        continue
+                    moving.add(id(reservation))
+                events.append((entry[0], entry[2]))
+            self.outbox.append((driver, events))
+
+        self.drivers = [driver for driver in self.drivers if id(driver) not in leaving_ids]
+        self.reservations = [reservation for reservation in self.reservations if id(reservation) not in moving]
+        queue[:] = staying
+        heapq.heapify(queue)
+
+    def receive_driver(self, driver, events):
+        """Takes over a driver handed off by another shard"""
+        self.drivers.append(driver)
+        self.reservations.extend(driver['current_reservations'])
+        for event_time, event in events:
+            if event['event_type'] == 'reservation assignment':
+                self.reservations.append(event['event']['reservation'])
+            self.future_event_list.put((event_time, event))
+
+    def receive_reservation(self, reservation, preset_driver_id, time):
+        """Queues the reservation event of a reservation the coordinator dispatched
+           at time, its reservation time unless it was waiting in another shard"""
+        self.add_reservation(**reservation)
+        self.reservations[-1]['preset_driver_id'] = preset_driver_id
+        self.future_event_list.put(
+            (
+                time,
+                {
+                    'event_type': 'reservation',
+                    'event': {
+                        'reservation': self.reservations[-1]
+                    }
+                }
+            )
+        )
+
+    def withdraw_reservation(self, reservation_id, time):
+        """Gives up a waiting reservation an idle driver of another shard pulled"""
+        reservation = self.waiting.withdraw(reservation_id, time)
+        self.reservations = [kept for kept in self.reservations if kept is not reservation]
+
+    def next_event_time(self):
+        queue = self.future_event_list.queue
+        return queue[0][0] if len(queue) > 0 else None
+
+    def results(self):
+        """The reservations and drivers of the shard without references between them,
+           so they can be sent to the coordinator"""
+        reservations = []
+        for reservation in self.reservations:
+            result = {key: value for key, value in reservation.items() if key != 'driver'}
+            result['driver_id'] = -1 if reservation['driver'] is None else reservation['driver']['driver_id']
+            reservations.append(result)
+        drivers = []
+        for driver in self.drivers:
+            drivers.append({
+                'driver_id': driver['driver_id'],
+                'capacity': driver['capacity'],
+                'current_location': driver['current_location'],
+                'serviced_passengers': len(driver['serviced_passengers'])
+            })
+        return {
+            'reservations': reservations,
+            'drivers': drivers,
+            'events': len(self.all_events),
+            'wait_times': self.waiting.wait_times,
+            'still_waiting': len(self.waiting)
+        }
+
+
+def run_shard(connection, shard, bounds, drivers, policy, min_block_time, arguments, seed):
+    """Worker process of one shard. Handles one time window per 'advance' command
+       and answers with the handed off drivers, the ids of the reservations it
+       queued and pulled, the time of its next event and snapshots of the
+       drivers that changed since the last answer."""
+    np.random.seed(seed)
+    sim = ShardSimulation(shard, bounds, drivers, policy, min_block_time, **arguments)
+    sim.log = open(sim.events_file, 'w')
+    # the snapshots the coordinator has of the drivers of the shard
+    sent = {driver['driver_id']: driver_snapshot(driver) for driver in sim.drivers}
+    while True:
+        command, until, messages = connection.recv()
+        if command == 'finish':
+            break
+        for message in messages:
+            if message[0] == 'driver':
+                sim.receive_driver(*message[1:])
+                sent[message[1]['driver_id']] = driver_snapshot(message[1])
+            elif message[0] == 'withdraw':
+                sim.withdraw_reservation(*message[1:])
+            else:
+                sim.receive_reservation(*message[1:])
+        sim.advance(until)
+        sim.hand_off()
+        outbox, sim.outbox = sim.outbox, []
+        for driver, _ in outbox:
+            del sent[driver['driver_id']]
+        changed = []
+        for driver in sim.drivers:
+            snapshot = driver_snapshot(driver)
+            if sent[driver['driver_id']] != snapshot:
+                sent[driver['driver_id']] = snapshot
+                changed.append(snapshot)
+        queued, pulled = sim.waiting.report()
+        connection.send((outbox, queued, pulled, sim.next_event_time(), changed))
+    sim.log.close()
+    connection.send(sim.results())
+    connection.close()
+
+
+def receive(connection, shard):
+    """Receives the answer of a shard, a worker that died raises a RuntimeError"""
+    try:
+        return connection.recv()
+    except EOFError:
+        raise RuntimeError('shard {} exited without answering, see its traceback above'.format(shard))
+
+
+def pull_waiting(policy, snapshots, waiting, time):
+    """Lets the idle drivers of a sharded run pull from the waiting queues of all
+       shards, like an idle driver pulls from Simulation.waiting. In its shard an
+       idle driver only finds the reservations waiting in its own region, the
+       coordinator offers it those of the other regions between windows.
+
+    Args:
+        policy (DispatchPolicy): dispatch policy of the run
+        snapshots (dict): driver id to snapshot, pulled seats are promised in copies
+        waiting (list): reservations waiting in any shard, oldest first
+        time (float): time of the decision
+
+    Returns:
+        list of (driver snapshot, reservation)
+
+    """
+
+    pulls = []
+    for driver in [driver for driver in snapshots.values() if driver['idle']]:
+        if len(waiting) == 0:
+            break
+        candidates = ReservationCandidates(waiting, time)
+        assignments = ride_alone(policy.dispatch(DriverCandidates([driver]), candidates), candidates)
+        if len(assignments) == 0:
+            continue
+        driver = snapshots[driver['driver_id']] = dict(driver, idle=False)
+        for _, j in assignments:
+            driver['seats_promised'] += waiting[j]['party_size']
+            pulls.append((driver, waiting[j]))
+        pulled = set(j for _, j in assignments)
+        waiting = [reservation for j, reservation in enumerate(waiting) if j not in pulled]
+    return pulls
+
+
+class ShardedRun(object):
+    def __init__(self, shard_results, windows, handoffs, wait_times):
+        """Merged results of a sharded run. Every reservation and driver ends up in
+           exactly one shard, so they are simply collected and sorted by id.
+
+        Attributes:
+            reservations: reservation dictionaries, with driver_id instead of driver
+            drivers: driver summaries
+            num_events: events handled by all shards
+            windows: number of time windows
+            handoffs: number of times a driver changed shards
+            wait_times: seconds every reservation pulled from a waiting queue waited,
+                in its shard or by an idle driver of another shard (argument)
+            still_waiting: reservations left in the waiting queues
+
+        """
+
+        self.reservations = sorted((reservation for result in shard_results for reservation in result['reservations']),
+                                   key=lambda reservation: reservation['reservation_id'])
+        self.drivers = sorted((driver for result in shard_results for driver in result['drivers']),
+                              key=lambda driver: driver['driver_id'])
+        self.num_events = sum(result['events'] for result in shard_results)
+        self.wait_times = [wait for result in shard_results for wait in result['wait_times']] + wait_times
+        self.still_waiting = sum(result['still_waiting'] for result in shard_results)
+        self.windows = windows
+        self.handoffs = handoffs
+
+
+def run_sharded(num_shards=2, seed=0, min_block_time=20.0, events_file=os.devnull, **arguments):
+    """Runs a simulation split into num_shards regions, each in its own process
+
+    The reservations and drivers are drawn exactly as a single Simulation with the
+    same seed would draw them. Every region starts with the drivers in it. The
+    shards synchronise with conservative time windows of min_block_time seconds,
+    the least time a driver needs for a block. Every shard handles a window
+    without waiting for the others, drivers that crossed into another region are
+    handed over with their queued events between windows. Windows without events
+    are skipped.
+
+    Between windows the coordinator dispatches the reservations made in the next
+    window with the dispatch policy, over a snapshot of the drivers of all shards,
+    and sends each one to the shard of its driver. Dispatch therefore still finds
+    drivers across region borders, it only sees their state up to one window late.
+    The coordinator also keeps a copy of the waiting queues of all shards and lets
+    idle drivers pull from the queues of other shards, see pull_waiting.
+
+    Args:
+        num_shards (int): number of regions and worker processes
+        seed (int): numpy seed of the demand, shard k uses seed + k + 1
+        min_block_time (float): lookahead, the least time it takes to drive a block
+        events_file (str): event log of every shard, may contain {shard}
+        arguments: keyword arguments of Simulation
+
+    Returns:
+        ShardedRun
+
+    """
+
+    np.random.seed(seed)
+    source = Simulation(events_file=os.devnull, **arguments)
+    policy = source.dispatch_policy
+    bounds = region_bounds(source.grid_size, num_shards)
+    demand = [demand_of(reservation) for reservation in sorted(source.reservations, key=lambda reservation: reservation['reserve_time'])]
+    reservations = {reservation['reservation_id']: reservation for reservation in source.reservations}
+    # id of every waiting reservation to the shard it waits in, oldest first
+    waiting = {}
+    wait_times = []
+    drivers = [[] for _ in bounds]
+    for driver in source.drivers:
+        drivers[region_of(bounds, driver['current_location'][0])].append(driver)
+    # latest snapshot of every driver, the shards only send the ones that changed
+    snapshots = {driver['driver_id']: driver_snapshot(driver) for driver in source.drivers}
+
+    shard_arguments = {key: value for key, value in arguments.items()
+                       if key not in ('time', 'num_drivers', 'num_reservations', 'carpool_threshold', 'dispatch_policy')}
+    connections = []
+    processes = []
+    try:
+        for shard in range(num_shards):
+            connection, worker_connection = multiprocessing.Pipe()
+            shard_arguments['events_file'] = events_file.format(shard=shard)
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(worker_connection, shard, bounds, drivers[shard], policy, min_block_time,
+                      dict(shard_arguments), seed + shard + 1)
+            )
+            process.start()
+            # only the worker holds its end, so recv raises EOFError once the worker is gone
+            worker_connection.close()
+            connections.append(connection)
+            processes.append(process)
+
+        window_start = demand[0]['reserve_time'] if len(demand) > 0 else 0.0
+        next_reservation = 0
+        windows = 0
+        handoffs = 0
+        inboxes = [[] for _ in bounds]
+        while True:
+            until = window_start + min_block_time
+
+            # DISPATCH THE RESERVATIONS OF THE WINDOW OVER ALL DRIVERS
+            start = next_reservation
+            while next_reservation < len(demand) and demand[next_reservation]['reserve_time'] < until:
+                next_reservation += 1
+            if next_reservation > start:
+                batch = demand[start:next_reservation]
+                candidates = [dict(reservation, current_location=list(reservation['pickup_coords'])) for reservation in batch]
+                fleet = list(snapshots.values())
+                preset = {}
+                for i, j in policy.dispatch(DriverCandidates(fleet), ReservationCandidates(candidates, window_start)):
+                    preset[j] = fleet[i]
+                for j, reservation in enumerate(batch):
+                    if j in preset:
+                        shard = region_of(bounds, preset[j]['current_location'][0])
+                        inboxes[shard].append(('reservation', reservation, preset[j]['driver_id'], reservation['reserve_time']))
+                    else:
+                        inboxes[region_of(bounds, reservation['pickup_coords'][0])].append(('reservation', reservation, None, reservation['reserve_time']))
+
+            for shard, connection in enumerate(connections):
+                connection.send(('advance', until, inboxes[shard]))
+            inboxes = [[] for _ in bounds]
+            next_times = []
+            for shard, connection in enumerate(connections):
+                outbox, queued, pulled, next_time, changed = receive(connection, shard)
+                for reservation_id in queued:
+                    waiting[reservation_id] = shard
+                for reservation_id in pulled:
+                    del waiting[reservation_id]
+                for snapshot in changed:
+                    snapshots[snapshot['driver_id']] = snapshot
+                for driver, events in outbox:
+                    inboxes[region_of(bounds, driver['current_location'][0])].append(('driver', driver, events))
+                    snapshots[driver['driver_id']] = driver_snapshot(driver)
+                    if len(events) > 0:
+                        next_times.append(events[0][0])
+                handoffs += len(outbox)
+                if next_time is not None:
+                    next_times.append(next_time)
+            if next_reservation < len(demand):
+                next_times.append(demand[next_reservation]['reserve_time'])
+
+            # IDLE DRIVERS PULL THE RESERVATIONS WAITING IN OTHER SHARDS AT THE START OF THE NEXT WINDOW
+            if len(waiting) > 0:
+                for driver, reservation in pull_waiting(policy, snapshots, [reservations[reservation_id] for reservation_id in waiting], until):
+                    inboxes[waiting.pop(reservation['reservation_id'])].append(('withdraw', reservation['reservation_id'], until))
+                    inboxes[region_of(bounds, driver['current_location'][0])].append(
+                        ('reservation', demand_of(reservation), driver['driver_id'], until))
+                    wait_times.append(until - reservation['reserve_time'])
+                    next_times.append(until)
+            windows += 1
+            if len(next_times) == 0:
+                break
+            window_start = min(next_times)
+
+        for connection in connections:
+            connection.send(('finish', None, None))
+        shard_results = [receive(connection, shard) for shard, connection in enumerate(connections)]
+        for process in processes:
+            process.join()
+    finally:
+        # a worker failed, stop the others that wait for the next window
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for connection in connections:
+            connection.close()
+
+    return ShardedRun(shard_results, windows, handoffs, wait_times)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the ride sharing simulation sharded over worker processes')
+    parser.add_argument('--shards', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--drivers', type=int, default=100)
+    parser.add_argument('--reservations', type=int, default=1000)
+    parser.add_argument('--grid-size', type=int, default=40)
+    parser.add_argument('--time', type=float, default=36000.0)
+    parser.add_argument('--min-block-time', type=float, default=20.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', action='store_true', help='also run the single process engine')
+    args = parser.parse_args()
+
+    arguments = {
+        'num_drivers': args.drivers,
+        'num_reservations': args.reservations,
+        'grid_size': args.grid_size,
+        'time': args.time
+    }
+    output = {}
+
+    start = time.perf_counter()
+    sharded = run_sharded(args.shards, args.seed, args.min_block_time, **arguments)
+    output['sharded'] = summarize(sharded)
+    output['sharded'].update({
+        'seconds': time.perf_counter() - start,
+        'events': sharded.num_events,
+        'windows': sharded.windows,
+        'handoffs': sharded.handoffs,
+        'still_waiting': sharded.still_waiting,
+        'mean_wait': float(np.mean(sharded.wait_times)) if len(sharded.wait_times) > 0 else 0.0
+    })
+
+    if args.compare:
+        start = time.perf_counter()
+        np.random.seed(args.seed)
+        sim = Simulation(events_file=os.devnull, **arguments)
+        sim.run()
+        output['single'] = summarize(sim)
+        output['single'].update({
+            'seconds': time.perf_counter() - start,
+            'events': len(sim.all_events),
+            'still_waiting': len(sim.waiting),
+            'mean_wait': sim.waiting.summary()['mean_wait']
+        })
+
+    print(json.dumps(output, indent=4))
@@ -3,14 +3,93 @@ import json
 import numpy as np
 import scipy.stats as st
 from queue import PriorityQueue
+from heapq import heappush, heappop
+import itertools
+import collections
 import copy
 import math
 
+from dispatch import DriverCandidates, ReservationCandidates, GreedyNearest, ride_alone
+
 pp = pprint.PrettyPrinter(indent=4)
-f = open('events.txt', 'w')
+
+
+class FutureEventList(PriorityQueue):
+    """PriorityQueue of (time, event) tuples. Events scheduled for the same time are
+       handed out in the order they were put instead of comparing the event dictionaries."""
+
+    def _init(self, maxsize):
+        PriorityQueue._init(self, maxsize)
+        self.counter = itertools.count()
+
+    def _put(self, item):
+        heappush(self.queue, (item[0], next(self.counter), item[1]))
+
+    def _get(self):
+        time, _, event = heappop(self.queue)
+        return time, event
+
+
+class WaitingQueue(object):
+    def __init__(self):
+        """FIFO queue of the reservations no driver had room for when they were made.
+           Drivers that free seats pull from it, so a waiting reservation is looked
+           at by the drivers that can take it instead of being dispatched again.
+           A driver that drops off a rider and still has others pulls carpool
+           reservations at its next intersection arrival, less than a second
+           later. Reservations that do not approve of a carpool wait for a
+           driver that has turned idle, which pulls one of them alone or only
+           carpool reservations, see dispatch.ride_alone.
+
+        Attributes:
+            reservations: deque of waiting reservation dictionaries, oldest first
+            backlog: (time, number of waiting reservations) after every change
+            wait_times: seconds from reservation until a driver pulled it, of every
+                reservation that left the queue
+
+        """
+
+        self.reservations = collections.deque()
+        self.backlog = []
+        self.wait_times = []
+
+    def __len__(self):
+        return len(self.reservations)
+
+    def __iter__(self):
+        return iter(self.reservations)
+
+    def push(self, reservation, time):
+        self.reservations.append(reservation)
+        self.backlog.append((time, len(self.reservations)))
+
+    def pull(self, reservations, time):
+        """Removes reservations a driver was assigned to from the queue"""
+        pulled = set(id(reservation) for reservation in reservations)
+        if len(pulled) == 0:
+            return
+        self.reservations = collections.deque(reservation for reservation in self.reservations if id(reservation) not in pulled)
+        self.wait_times.extend(time - reservation['reserve_time'] for reservation in reservations)
+        self.backlog.append((time, len(self.reservations)))
+
+    def summary(self):
+        """Largest and time weighted mean backlog, and the wait of pulled reservations in seconds"""
+        sizes = np.array([size for _, size in self.backlog], dtype=float)
+        times = np.array([time for time, _ in self.backlog], dtype=float)
+        durations = np.diff(times)
+        return {
+            'still_waiting': len(self.reservations),
+            'pulled': len(self.wait_times),
+            'max_backlog': int(sizes.max()) if len(sizes) > 0 else 0,
+            'mean_backlog': float((sizes[:-1] * durations).sum() / durations.sum()) if durations.sum() > 0 else 0.0,
+            'mean_wait': float(np.mean(self.wait_times)) if len(self.wait_times) > 0 else 0.0,
+            'max_wait': float(np.max(self.wait_times)) if len(self.wait_times) > 0 else 0.0
+        }
+
 
 class Simulation(object):
-    def __init__(self, time=7200.0, num_drivers=20, num_reservations=100, carpool_threshold=3):
+    def __init__(self, time=7200.0, num_drivers=20, num_reservations=100, carpool_threshold=None,
+                 grid_size=20, events_file='events.txt', profiler=None, demand=None, dispatch_policy=None):
         """Ride Sharing Discrete Event Simulation
 
         This module populates and maintains a future event list of a ride-sharing 
@@ -19,7 +98,7 @@ class Simulation(object):
         Intersection Arrival, Pick Up, Drop Off, and Idle Arrival. The simulation 
         terminates when either the maximum input time is reached or the goal number 
         of reservations are fulfilled. This class is instantiated by the LynxRideSharing 
-        game object. Other information: 20x20 intersections, intersection arrival
+        game object. Other information: 20x20 intersections by default, intersection arrival
         follows a normal distribution, reservations follow an exponential distribution.
         Pickup destinations are random, but dropoff destinations depend on the "time 
         of day" and "type of street", party size of a reservation and driver capacity
@@ -32,7 +111,16 @@ class Simulation(object):
             num_reservations (int): The goal number of reservations
             carpool_threshold (int): The maximum number of blocks a driver should
                 veer off its path given that its fulfulling a reservation and the
-                reservations approves of a carpool.
+                reservations approves of a carpool, 3 by default.
+                Only used by the default dispatch policy, pass it to the policy otherwise.
+            grid_size (int): The number of streets in each direction, at least 5
+                so that there is a government street
+            events_file (str): Path of the text log written by run
+            profiler (SimulationProfiler): Optional instrumentation, see profiling.py
+            demand (list): Optional fixed reservations replacing the random ones, see
+                replay.py. Each is a dictionary with the arguments of add_reservation.
+            dispatch_policy (DispatchPolicy): Decides which driver serves which
+                reservation, see dispatch.py. Defaults to GreedyNearest(carpool_threshold).
         
         Attributes:
             reservations: list of reservation dictionaries
@@ -42,20 +130,49 @@ class Simulation(object):
             time: time of the simulation (argument)
             num_drivers: number of drivers (argument)
             num_reservations: number of reservations (argument)
-            carpool_threshold: carpool threshold when drivers are fulfilling reservations
+            carpool_threshold: carpool threshold of the dispatch policy, None if it has none
+            grid_size: number of streets in each direction (argument)
+            events_file: path of the event log (argument)
+            profiler: instrumentation of the run, None when disabled (argument)
+            random: numpy.random, or a stand in that counts calls when profiling
+            demand: fixed reservations, None when they are drawn at random (argument)
+            dispatch_policy: policy assigning drivers to reservations (argument)
+            waiting: queue of the reservations no driver had room for
+            log: the event log, open while the simulation runs
 
         """
 
+        if grid_size < 5:
+            raise ValueError('grid_size must be at least 5, every fourth street from the fifth on is a government street')
+
         self.reservations = []
         self.drivers = []
-        self.future_event_list = PriorityQueue()
+        self.future_event_list = FutureEventList()
+        self.waiting = WaitingQueue()
         self.all_events = []
         self.time = time
         self.num_drivers = num_drivers
         self.num_reservations = num_reservations
-        self.carpool_threshold = carpool_threshold
+        self.grid_size = grid_size
+        self.events_file = events_file
+        self.profiler = profiler
+        self.random = np.random if profiler is None else profiler.wrap_random(np.random)
+        self.demand = demand
+        if dispatch_policy is None:
+            self.carpool_threshold = 3 if carpool_threshold is None else carpool_threshold
+            self.dispatch_policy = GreedyNearest(self.carpool_threshold)
+        elif carpool_threshold is not None:
+            raise ValueError('carpool_threshold is a setting of the dispatch policy, pass it to the policy instead')
+        else:
+            self.carpool_threshold = getattr(dispatch_policy, 'carpool_threshold', None)
+            self.dispatch_policy = dispatch_policy
 
-        self.initialize_reservations()
+        if demand is not None:
+            self.num_reservations = len(demand)
+            for reservation in demand:
+                self.add_reservation(**reservation)
+        else:
+            self.initialize_reservations()
         self.initialize_drivers(num_drivers)
         self.initialize_future_event_list()
 
@@ -68,7 +185,7 @@ class Simulation(object):
             # if time % 60.0 == 0.0:
             if len(self.reservations) < self.num_reservations:
                 # self.create_reservation(time)
-                time += np.random.exponential(scale=30.0)
+                time += self.random.exponential(scale=30.0)
                 self.create_reservation(time)
                 # ime += new_time
                 # print(time)
@@ -87,7 +204,7 @@ class Simulation(object):
 
         """
 
-        party_size = np.random.choice(np.arange(1,5), 1, p=[0.6, 0.25, 0.10, 0.05])[0]
+        party_size = self.random.choice(np.arange(1,5), 1, p=[0.6, 0.25, 0.10, 0.05])[0]
         reserve_time = time
 
         # RESERVATION PARTY SIZE WHICH DETERMINES PROBABILITY OF ACCEPTING CARPOOLS
@@ -99,32 +216,61 @@ class Simulation(object):
             prob = [0.55, 0.45]
         else:
             prob = [0.70, 0.30]
-        carpool = np.random.choice(2, 1, p=prob)[0]
-
-        # STREETS
-        gov_streets = [4,8,12,16]
-        streets = list(range(20))
+        carpool = self.random.choice(2, 1, p=prob)[0]
 
         # S1, A1 (PICKUP LOCATION)
-        pickup_coords = [np.random.choice(20, 1)[0], np.random.choice(20, 1)[0]]
+        pickup_coords = [self.random.choice(self.grid_size, 1)[0], self.random.choice(self.grid_size, 1)[0]]
 
         # S2, A2 (DROPOFF LOCATION, DEPENDS ON TIME OF DAY AND TYPE OF STREET)
-        time_of_day = np.random.choice(2, 1, p=[0.75, 0.25])[0]
+        dropoff_coords = self.random_dropoff_coords(self.random, self.grid_size)
+
+        self.add_reservation(time, party_size, carpool, pickup_coords, dropoff_coords)
+
+    @staticmethod
+    def random_dropoff_coords(random, grid_size):
+        """Draws a dropoff location. Most dropoffs are on a government street,
+           every fourth street, the rest are on any other street.
+
+        Args:
+            random: numpy.random or a numpy RandomState
+            grid_size (int): The number of streets in each direction
+
+        """
+
+        # STREETS, EVERY FOURTH STREET IS A GOVERNMENT STREET
+        gov_streets = list(range(4, grid_size, 4))
+        streets = list(range(grid_size))
+
+        time_of_day = random.choice(2, 1, p=[0.75, 0.25])[0]
 
         if time_of_day == 0:
-            a2 = np.random.choice(gov_streets, 1)
+            a2 = random.choice(gov_streets, 1)
         else:
-            a2 = np.random.choice([x for x in streets if x not in gov_streets], 1)
+            a2 = random.choice([x for x in streets if x not in gov_streets], 1)
+
+        return (random.choice(grid_size, 1)[0], a2[0])
+
+    def add_reservation(self, reserve_time, party_size, carpool, pickup_coords, dropoff_coords, reservation_id=None):
+        """Appends a reservation that has not been assigned yet
+
+        Args:
+            reserve_time (float): The time of the reservation
+            party_size (int): The number of passengers
+            carpool (int): 1 if the reservation approves of a carpool, else 0
+            pickup_coords (tuple): The pickup intersection
+            dropoff_coords (tuple): The dropoff intersection
+            reservation_id (int): Id to keep, by default the next free one
 
-        dropoff_coords = (np.random.choice(20, 1)[0], a2[0])
+        """
 
         self.reservations.append({
-            'reservation_id': len(self.reservations),
+            'reservation_id': len(self.reservations) if reservation_id is None else reservation_id,
             'party_size': party_size,
-            'reserve_time': time,
-            'dropoff_coords': dropoff_coords,
+            'reserve_time': reserve_time,
+            'dropoff_coords': tuple(dropoff_coords),
             'carpool': carpool,
-            'current_location': pickup_coords,
+            'pickup_coords': tuple(pickup_coords),
+            'current_location': list(pickup_coords),
             'assigned': False,
             'picked_up': False,
             'pickup_time': -1,
@@ -142,8 +288,8 @@ class Simulation(object):
         """
 
         for i in range(num_drivers):
-            starting_coords = pickup_coords = [np.random.choice(20, 1)[0], np.random.choice(20, 1)[0]]
-            capacity = np.random.choice(list(range(1,7)), 1, p=[0.05, 0.05, 0.40, 0.30, 0.15, 0.05])[0]
+            starting_coords = pickup_coords = [self.random.choice(self.grid_size, 1)[0], self.random.choice(self.grid_size, 1)[0]]
+            capacity = self.random.choice(list(range(1,7)), 1, p=[0.05, 0.05, 0.40, 0.30, 0.15, 0.05])[0]
             self.drivers.append({
                 'driver_id': i,
                 'initial_location': starting_coords,
@@ -151,6 +297,7 @@ class Simulation(object):
                 'idle': True,
                 'capacity': capacity,
                 'seats_filled': 0,
+                'seats_promised': 0,
                 'current_reservations': [],
                 'serviced_passengers': []
             })
@@ -181,8 +328,22 @@ class Simulation(object):
            makes it much easier than keeping track of a second priority. One an event
            is popped, its event type is checked an action is taken accordingly. """
 
+        self.log = open(self.events_file, 'w')
+        self.advance()
+        self.log.close()
+
+    def advance(self, until=None):
+        """Handles events until the future event list is empty or, if until is given,
+           until the next event takes place at or after until. Expects the log to be open."""
+
+        f = self.log
+        profiler = self.profiler
         while not self.future_event_list.empty():
-            shifter = np.random.uniform(0.0, 1.0)
+            if until is not None and self.future_event_list.queue[0][0] >= until:
+                break
+            if profiler is not None:
+                started = profiler.clock()
+            shifter = self.random.uniform(0.0, 1.0)
             next_event = self.future_event_list.get()
             self.all_events.append(copy.deepcopy(next_event))
             event_type = next_event[1]['event_type']
@@ -198,34 +359,34 @@ class Simulation(object):
                 # RESERVATION EVENT
                 reservation1 = next_event[1]['event']['reservation']
                 current_time = next_event[0]
-                # ISOLATE AVAILABLE DRIVERS
-                available_drivers = [driver for driver in self.drivers if driver['capacity'] - driver['seats_filled'] >= reservation1['party_size']]
-                # FIND THE CLOSEST DRIVER TO THE CURRENT RESERVATION
-                if len(available_drivers) > 0 and not reservation1['assigned']:
-                    passenger_location = reservation1['current_location']
-                    min_dist = 1000000
-                    closest_available_driver = None
-                    for driver in available_drivers:
-                        driver_location = driver['current_location']
-                        dist = np.linalg.norm(np.array(driver_location) - np.array(passenger_location))
-                        if dist < min_dist:
-                            min_dist = dist
-                            closest_available_driver = driver
-                    closest_available_driver['idle'] = False
-
-                    # TRIGGER A 'reservation assignment' EVENT
-                    self.future_event_list.put(
-                        (
-                            current_time + shifter,
-                            {
-                                'event_type': 'reservation assignment',
-                                'event': {
-                                    'driver': closest_available_driver,
-                                    'reservation': reservation1
+                # LET THE DISPATCH POLICY CHOOSE A DRIVER FOR THE CURRENT RESERVATION
+                if not reservation1['assigned']:
+                    if profiler is not None:
+                        profiler.record_scan('dispatch', len(self.drivers))
+                    assignments = self.dispatch_policy.dispatch(
+                        DriverCandidates(self.drivers),
+                        ReservationCandidates([reservation1], current_time)
+                    )
+                    # NO DRIVER HAS ROOM, WAIT FOR ONE THAT FREES SEATS
+                    if len(assignments) == 0:
+                        self.waiting.push(reservation1, current_time)
+                    for i, _ in assignments:
+                        self.drivers[i]['idle'] = False
+                        self.drivers[i]['seats_promised'] += reservation1['party_size']
+
+                        # TRIGGER A 'reservation assignment' EVENT
+                        self.future_event_list.put(
+                            (
+                                current_time + shifter,
+                                {
+                                    'event_type': 'reservation assignment',
+                                    'event': {
+                                        'driver': self.drivers[i],
+                                        'reservation': reservation1
+                                    }
                                 }
-                            }
+                            )
                         )
-                    )
                 
                 f.write('{}, {}, {}, ResId: {}, Party: {}, Pool: {}\n'.format(
                                               round(current_time), 
@@ -243,6 +404,7 @@ class Simulation(object):
                 driver = event['driver']
                 reservation2 = event['reservation']
                 current_time = next_event[0]
+                driver['seats_promised'] -= reservation2['party_size']
 
                 if not reservation2['assigned']:
                     reservation2 = event['reservation']
@@ -281,38 +443,31 @@ class Simulation(object):
                 current_time = next_event[0]
                 reservations = driver['current_reservations']
 
-                # # an optimized version of carpooling that does not yet work: check if there is an unassigned reservation nearby. If so, trigger assignment event
-                for res in self.reservations:
-                    # check for unassigned reservations
-                    if not res['assigned'] and res['carpool']:
-                        print('carpool')
-                        reservation_location = res['current_location']
-                        party_size = res['party_size']
-                        driver_location = driver['current_location']
-                        capacity = driver['capacity']
-                        seats_filled = driver['seats_filled']
-
-                        # check if driver has space
-                        if party_size <= capacity - seats_filled and not res['assigned']:
-                            # check if reservation is close enough
-                            dx = abs(reservation_location[0] - driver_location[0])
-                            dy = abs(reservation_location[1] - driver_location[1])
-                            if dx <= self.carpool_threshold and dy <= self.carpool_threshold:
-                                # print('From intersection arriva: {}'.format(self.assignment_calls_from_intersection_arrival))
-
-                                self.future_event_list.put(
-                                    (
-                                        current_time + shifter,
-                                        {
-                                            'event_type': 'reservation assignment',
-                                            'event': {
-                                                'driver': driver,
-                                                'reservation': res
-                                            }
-                                        }
-                                    )
-                                )
-                                break
+                # CHECK IF THERE IS AN UNASSIGNED CARPOOL RESERVATION THE DRIVER SHOULD PICK UP ON ITS WAY
+                carpools = [res for res in self.waiting if res['carpool']]
+                if profiler is not None:
+                    profiler.record_scan('carpool', len(carpools))
+                assignments = []
+                if len(carpools) > 0:
+                    assignments = self.dispatch_policy.carpool(
+                        DriverCandidates([driver]),
+                        ReservationCandidates(carpools, current_time)
+                    )
+                for _, j in assignments:
+                    driver['seats_promised'] += carpools[j]['party_size']
+                    self.future_event_list.put(
+                        (
+                            current_time + shifter,
+                            {
+                                'event_type': 'reservation assignment',
+                                'event': {
+                                    'driver': driver,
+                                    'reservation': carpools[j]
+                                }
+                            }
+                        )
+                    )
+                self.waiting.pull([carpools[j] for _, j in assignments], current_time)
 
                 if len(driver['current_reservations']) > 0:
                     # GO TO NEAREST RESERVATION
@@ -362,7 +517,6 @@ class Simulation(object):
                             )
                         )
 
-                    print(reservations)
                     res_ids = ','.join([str(res['reservation_id']) for res in reservations])
                     res_locations = ','.join([str(tuple(res['current_location'])) for res in reservations])
 
@@ -457,29 +611,38 @@ class Simulation(object):
                 current_time = next_event[0]
                 driver['idle'] = True
 
-                for res in self.reservations:
-                    if not res['assigned']:
-                        self.future_event_list.put(
-                            (
-                                current_time,
-                                {
-                                    'event_type': 'reservation',
-                                    'event': {
-                                        'reservation': res
-                                    }
+                # LET THE DISPATCH POLICY CHOOSE WHICH WAITING RESERVATIONS THE IDLE DRIVER PULLS FROM THE QUEUE,
+                # A RESERVATION THAT DOES NOT APPROVE OF A CARPOOL IS PULLED ALONE
+                waiting = list(self.waiting)
+                if profiler is not None:
+                    profiler.record_scan('idle', len(waiting))
+                assignments = []
+                if len(waiting) > 0:
+                    candidates = ReservationCandidates(waiting, current_time)
+                    assignments = ride_alone(self.dispatch_policy.dispatch(DriverCandidates([driver]), candidates), candidates)
+                for _, j in assignments:
+                    driver['idle'] = False
+                    driver['seats_promised'] += waiting[j]['party_size']
+                    self.future_event_list.put(
+                        (
+                            current_time + shifter,
+                            {
+                                'event_type': 'reservation assignment',
+                                'event': {
+                                    'driver': driver,
+                                    'reservation': waiting[j]
                                 }
-                            )
+                            }
                         )
-                        break
-                
+                    )
+                self.waiting.pull([waiting[j] for _, j in assignments], current_time)
 
                 f.write('{}, {}, {}, DriverId: {}\n'.format(round(current_time, 1), event_type, tuple(driver['current_location']), driver['driver_id']))
 
+            if profiler is not None:
+                profiler.record_event(event_type, started, next_event[0], self.future_event_list.qsize())
 
-        f.close()
-
-    @staticmethod
-    def update_locations(driver, closest_reservation, picked_up = False):
+    def update_locations(self, driver, closest_reservation, picked_up = False):
         """Take driver and passenger to an intersection that is closer to the destination"""
 
         driver_location = driver['current_location']
@@ -487,7 +650,7 @@ class Simulation(object):
         current_reservation_location = closest_reservation['current_location']
         dx = current_reservation_location[0] - driver_location[0]
         dy = current_reservation_location[1] - driver_location[1]
-        intersection_arrival_time_length = np.random.normal(60, 20)
+        intersection_arrival_time_length = self.random.normal(60, 20)
 
         if dx == 0 and dy == 0:
             if not picked_up:
@@ -516,7 +679,7 @@ class Simulation(object):
                             current_reservation_location[0] += 1
                     else:
                         # move randomly in either x or y
-                        x_or_y = np.random.choice([0, 1], 1)[0]
+                        x_or_y = self.random.choice([0, 1], 1)[0]
                         if x_or_y == 0:
                             if dx2 < 0:
                                 driver_location[0] -= 1
@@ -548,7 +711,7 @@ class Simulation(object):
                 driver_location[0] += 1
         else:
             # move randomly in either x or y
-            x_or_y = np.random.choice([0, 1], 1)[0]
+            x_or_y = self.random.choice([0, 1], 1)[0]
             if x_or_y == 0:
                 # move in the x direction
                 if dx < 0:
@@ -581,6 +744,21 @@ class Simulation(object):
                 current_reservation_location = reservation_location
         return current_reservation
 
+def summarize(sim):
+    """The share of passengers that paid for a ride, i.e. were picked up within 15 minutes.
+       It is None when there were no passengers."""
+    passengers = 0
+    free_ride_passengers = 0
+    for res in sim.reservations:
+        passengers += res['party_size']
+        if (res['pickup_time'] - res['reserve_time'])/60 > 15.0:
+            free_ride_passengers += res['party_size']
+    return {
+        'reservations': len(sim.reservations),
+        'passengers': int(passengers),
+        'paid_percentage': 1.0 - free_ride_passengers/passengers if passengers else None
+    }
+
 if __name__ == "__main__":
     num_drivers = 40
     passengers = 0
@@ -0,0 +1,240 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmark import compare
+from dispatch import DetourBoundedCarpool, DriverCandidates, EtaAware, GreedyNearest, ReservationCandidates, ride_alone
+from playback import Playback
+from replay import parse_events_log
+from sharding import driver_snapshot, pull_waiting, run_sharded
+from simulation import Simulation, WaitingQueue, summarize
+
+
+def make_driver(driver_id, location, capacity=4, seats_filled=0, seats_promised=0, current_reservations=()):
+    return {
+        'driver_id': driver_id,
+        'current_location': list(location),
+        'capacity': capacity,
+        'seats_filled': seats_filled,
+        'seats_promised': seats_promised,
+        'current_reservations': list(current_reservations),
+        'idle': len(current_reservations) == 0
+    }
+
+
+def make_reservation(reservation_id, pickup, dropoff=(0, 0), party_size=1, carpool=1, reserve_time=0.0, picked_up=False):
+    return {
+        'reservation_id': reservation_id,
+        'current_location': list(pickup),
+        'dropoff_coords': tuple(dropoff),
+        'party_size': party_size,
+        'carpool': carpool,
+        'reserve_time': reserve_time,
+        'picked_up': picked_up
+    }
+
+
+def test_waiting_queue_pull_keeps_order_and_records_waits():
+    queue = WaitingQueue()
+    reservations = [make_reservation(i, (0, 0), reserve_time=10.0 * i) for i in range(3)]
+    for reservation in reservations:
+        queue.push(reservation, reservation['reserve_time'])
+    queue.pull([reservations[1]], 30.0)
+
+    assert [reservation['reservation_id'] for reservation in queue] == [0, 2]
+    assert queue.wait_times == [20.0]
+    summary = queue.summary()
+    assert summary['still_waiting'] == 2
+    assert summary['pulled'] == 1
+    assert summary['max_backlog'] == 3
+    # one, two and three reservations waited for 10 seconds each
+    assert summary['mean_backlog'] == pytest.approx(2.0)
+    assert summary['mean_wait'] == summary['max_wait'] == 20.0
+
+
+def test_empty_waiting_queue_summary():
+    assert WaitingQueue().summary() == {
+        'still_waiting': 0, 'pulled': 0, 'max_backlog': 0, 'mean_backlog': 0.0, 'mean_wait': 0.0, 'max_wait': 0.0
+    }
+
+
+def test_greedy_nearest_skips_drivers_without_room():
+    drivers = DriverCandidates([
+        make_driver(0, (1, 1), capacity=2, seats_filled=1, seats_promised=1),
+        make_driver(1, (5, 5), capacity=2)
+    ])
+    reservations = ReservationCandidates([make_reservation(0, (0, 0)), make_reservation(1, (0, 0), party_size=3)])
+
+    assert drivers.free_seats.tolist() == [0, 2]
+    assert GreedyNearest().dispatch(drivers, reservations) == [(1, 0)]
+
+
+def test_greedy_nearest_does_not_overbook_within_a_dispatch():
+    drivers = DriverCandidates([make_driver(0, (0, 0), capacity=3), make_driver(1, (9, 9), capacity=3)])
+    reservations = ReservationCandidates([make_reservation(0, (1, 0), party_size=2), make_reservation(1, (1, 1), party_size=2)])
+
+    assert GreedyNearest().dispatch(drivers, reservations) == [(0, 0), (1, 1)]
+
+
+def test_greedy_carpool_only_offers_close_reservations():
+    driver = make_driver(0, (10, 10), current_reservations=[make_reservation(9, (10, 10), dropoff=(15, 10), picked_up=True)])
+    reservations = ReservationCandidates([make_reservation(0, (14, 10)), make_reservation(1, (12, 13))])
+
+    assert GreedyNearest(carpool_threshold=3).carpool(DriverCandidates([driver]), reservations) == [(0, 1)]
+    assert GreedyNearest(carpool_threshold=1).carpool(DriverCandidates([driver]), reservations) == []
+
+
+def test_eta_aware_prefers_a_free_driver_over_a_close_busy_one():
+    busy = make_driver(0, (0, 0), current_reservations=[make_reservation(9, (0, 0), dropoff=(19, 19), picked_up=True)])
+    free = make_driver(1, (5, 0))
+    drivers = DriverCandidates([busy, free])
+    reservations = ReservationCandidates([make_reservation(0, (1, 0))])
+
+    assert GreedyNearest().dispatch(drivers, reservations) == [(0, 0)]
+    assert EtaAware().dispatch(drivers, reservations) == [(1, 0)]
+
+
+def test_detour_bounded_carpool_picks_the_smallest_detour():
+    driver = make_driver(0, (0, 0), current_reservations=[make_reservation(9, (0, 0), dropoff=(10, 0), picked_up=True)])
+    reservations = ReservationCandidates([
+        make_reservation(0, (5, 3)),
+        make_reservation(1, (5, 1)),
+        make_reservation(2, (12, 0))
+    ])
+
+    assert DetourBoundedCarpool(max_detour=4).carpool(DriverCandidates([driver]), reservations) == [(0, 1)]
+    assert DetourBoundedCarpool(max_detour=1).carpool(DriverCandidates([driver]), reservations) == []
+
+
+def test_detour_bounded_carpool_has_no_carpool_threshold():
+    sim = Simulation(dispatch_policy=DetourBoundedCarpool(), events_file=os.devnull)
+    assert sim.carpool_threshold is None
+    with pytest.raises(ValueError):
+        Simulation(dispatch_policy=DetourBoundedCarpool(), carpool_threshold=3, events_file=os.devnull)
+
+
+def test_ride_alone_keeps_non_carpool_reservations_apart():
+    reservations = ReservationCandidates([
+        make_reservation(0, (0, 0), carpool=0),
+        make_reservation(1, (0, 0), carpool=0),
+        make_reservation(2, (0, 0), carpool=1),
+        make_reservation(3, (0, 0), carpool=1)
+    ])
+
+    assert ride_alone([(0, 0), (0, 1), (0, 2)], reservations) == [(0, 0)]
+    assert ride_alone([(0, 2), (0, 0), (0, 3)], reservations) == [(0, 2), (0, 3)]
+    assert ride_alone([(0, 0), (1, 1), (1, 2)], reservations) == [(0, 0), (1, 1)]
+
+
+def test_idle_driver_takes_one_non_carpool_rider_at_a_time():
+    np.random.seed(0)
+    demand = [
+        # fills the only driver, the next two riders have to wait
+        {'reserve_time': 0.0, 'party_size': 4, 'carpool': 0, 'pickup_coords': (2, 2), 'dropoff_coords': (6, 6)},
+        {'reserve_time': 10.0, 'party_size': 1, 'carpool': 0, 'pickup_coords': (7, 7), 'dropoff_coords': (9, 9)},
+        {'reserve_time': 20.0, 'party_size': 1, 'carpool': 0, 'pickup_coords': (7, 8), 'dropoff_coords': (9, 8)}
+    ]
+    sim = Simulation(num_drivers=1, demand=demand, events_file=os.devnull)
+    sim.drivers[0]['capacity'] = 4
+    sim.drivers[0]['current_location'] = [2, 2]
+    sim.run()
+
+    assigned = {event['event']['reservation']['reservation_id']: time
+                for time, event in sim.all_events if event['event_type'] == 'reservation assignment'}
+    first, second, third = sim.reservations
+    assert sim.waiting.summary()['pulled'] == 2
+    # the driver pulls the second rider once it is idle, the third only after that ride
+    assert assigned[1] > first['dropoff_time']
+    assert assigned[2] > second['dropoff_time'] > 0
+
+
+def test_idle_drivers_pull_across_shards():
+    snapshots = {driver['driver_id']: driver_snapshot(driver) for driver in [
+        make_driver(0, (0, 0)),
+        make_driver(1, (9, 9)),
+        make_driver(2, (5, 5), current_reservations=[make_reservation(9, (5, 5), dropoff=(6, 6), picked_up=True)])
+    ]}
+    busy = snapshots[2]
+    waiting = [make_reservation(0, (8, 8), carpool=0), make_reservation(1, (8, 9), carpool=0), make_reservation(2, (1, 1))]
+
+    pulls = pull_waiting(GreedyNearest(), snapshots, waiting, 100.0)
+
+    assert [(driver['driver_id'], reservation['reservation_id']) for driver, reservation in pulls] == [(0, 0), (1, 1)]
+    assert snapshots[0]['idle'] is False and snapshots[0]['seats_promised'] == 1
+    assert snapshots[2] is busy
+
+
+def test_sharded_run_serves_every_reservation_once():
+    run = run_sharded(2, seed=0, num_drivers=4, num_reservations=60, grid_size=10)
+
+    assert [reservation['reservation_id'] for reservation in run.reservations] == list(range(60))
+    assert run.still_waiting == 0
+    assert all(reservation['dropoff_time'] > 0 for reservation in run.reservations)
+
+
+def test_playback_hands_out_events_scheduled_slightly_in_the_past():
+    events = [(0.0, 'a'), (10.0, 'b'), (9.5, 'c'), (20.0, 'd')]
+    playback = Playback(events, speed=1.0)
+
+    assert playback.advance(5.0) == [(0.0, 'a')]
+    assert playback.advance(5.0) == [(10.0, 'b'), (9.5, 'c')]
+    assert not playback.finished()
+    assert playback.advance(15.0) == [(20.0, 'd')]
+    assert playback.finished()
+    assert playback.advance(1.0) == []
+
+
+def test_parse_events_log(tmp_path):
+    log = tmp_path / 'events.txt'
+    log.write_text(
+        '19, reservation, (19, 1), ResId: 0, Party: 2, Pool: 1\n'
+        '27, reservation, (5, 15), ResId: 1, Party: 3, Pool: 0\n'
+        '30, pick up, (5, 15), DriverId: 9, ResId: 1\n'
+        '30, pick up, (5, 16), DriverId: 9, ResId: 1\n'
+        '95.4, idle_arrival, (3, 3), DriverId: 9\n'
+        '95, reservation, (19, 1), ResId: 0, Party: 2, Pool: 1\n'
+        '96, drop off, (8, 4), DriverId: 9, ResId: 1\n'
+        '120.2, idle_arrival, (8, 4), DriverId: 9\n'
+        '120, reservation, (np.int64(2), np.int64(3)), ResId: 2, Party: 1, Pool: 0\n'
+    )
+
+    demand = parse_events_log(str(log), grid_size=20, seed=0)
+
+    assert [reservation['reserve_time'] for reservation in demand] == [19.0, 27.0, 120.0]
+    assert demand[1] == {'reserve_time': 27.0, 'party_size': 3, 'carpool': 0,
+                         'pickup_coords': (5, 15), 'dropoff_coords': (8, 4)}
+    # a re-post is only used for a reservation without another line
+    assert demand[2]['pickup_coords'] == (2, 3)
+    for reservation in (demand[0], demand[2]):
+        assert all(0 <= coordinate < 20 for coordinate in reservation['dropoff_coords'])
+
+
+def test_benchmark_compare_reports_regressions_beyond_tolerance():
+    baseline = {'scenarios': {
+        'small': {'run_seconds': 1.0, 'events_per_second': 1000.0, 'peak_memory_bytes': 0},
+        'medium': {'run_seconds': 2.0}
+    }}
+    results = {
+        'small': {'run_seconds': 1.05, 'events_per_second': 800.0, 'peak_memory_bytes': 100},
+        'medium': {'run_seconds': 2.5},
+        'large': {'run_seconds': 100.0}
+    }
+
+    regressions = compare(results, baseline, 0.1)
+
+    assert sorted((regression['scenario'], regression['metric']) for regression in regressions) == [
+        ('medium', 'run_seconds'), ('small', 'events_per_second')
+    ]
+    assert regressions[0]['change'] == pytest.approx(-0.2)
+
+
+def test_summarize_without_passengers():
+    sim = Simulation(demand=[], events_file=os.devnull)
+    sim.run()
+    assert summarize(sim) == {'reservations': 0, 'passengers': 0, 'paid_percentage': None}
+
+
+def test_grid_without_government_streets_is_rejected():
+    with pytest.raises(ValueError):
+        Simulation(grid_size=4, events_file=os.devnull)